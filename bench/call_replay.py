@@ -0,0 +1,50 @@
+import host
+import time
+import uasyncio as asyncio
+
+# Replays bursts of back-to-back RING/+CLIP sequences from different
+# callers, each +CLIP repeated the way the modem repeats it on every RING,
+# and reports how many calls were served and how long each one took from
+# its first +CLIP to being hung up
+CALLERS = 8
+REPEATS = 3
+RING_INTERVAL_MS = 20
+
+modem = host.Modem({'ATH': 'OK\r\n'}, delay_ms = 30)
+latencies = []
+
+async def device(sim800l):
+    while True:
+        event = await sim800l.device_queue.get()
+        if event['event'] == 'incoming-call':
+            asyncio.create_task(sim800l.open_gate('0700000000', event['caller']))
+
+async def run():
+    sim800l = host.start_modem(modem)
+    finish_call = sim800l.finish_call
+
+    def timed_finish_call(gate_opened):
+        if sim800l.current_call:
+            latencies.append(time.ticks_diff(time.ticks_ms(), sim800l.current_call.received))
+        finish_call(gate_opened)
+
+    sim800l.finish_call = timed_finish_call
+    sim800l.print = lambda *args: None
+    asyncio.create_task(device(sim800l))
+
+    start = time.ticks_ms()
+    for _ in range(REPEATS):
+        for i in range(CALLERS):
+            modem.urc(f'RING\r\n+CLIP: "07220000{i:02d}",129,"",0,"",0\r\n')
+            await asyncio.sleep_ms(RING_INTERVAL_MS)
+
+    while len(latencies) < CALLERS and time.ticks_diff(time.ticks_ms(), start) < 10000:
+        await asyncio.sleep_ms(10)
+    elapsed = time.ticks_diff(time.ticks_ms(), start)
+
+    stats = sim800l.call_stats
+    print(f'{CALLERS} callers x {REPEATS} +CLIP: served {stats["served"]}, duplicates {stats["duplicates"]}, rejected {stats["rejected"]}, expired {stats["expired"]}')
+    print(f'all served in {elapsed} ms, {sim800l.gate_openings_per_minute()} gate openings in the last minute')
+    host.report('+CLIP to hang up', latencies, 'ms')
+
+asyncio.run(run())
@@ -0,0 +1,76 @@
+import host
+import gc
+import time
+import caller_index
+
+# Heap and lookup time of the normalized caller index against the
+# allowed_callers dict the incoming call path looked numbers up in before:
+# an exact key lookup, which misses a caller calling as +40 when saved
+# as 07, and a scan of the keys that matches either format. Lookups mix
+# allowed callers with unknown numbers. The unix port reports the heap
+# with gc.mem_alloc(), CPython with tracemalloc
+SIZES = (100, 1000, 5000)
+LOOKUPS = 20000
+SCAN_LOOKUPS = 200
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def heap():
+    gc.collect()
+    if hasattr(gc, 'mem_alloc'):
+        return gc.mem_alloc()
+    return tracemalloc.get_traced_memory()[0]
+
+def callers(size):
+    return {f'07220{i:05d}': f'Caller {i}' for i in range(size)}
+
+def queries(size):
+    numbers = []
+    for i in range(LOOKUPS):
+        if i % 2:
+            numbers.append(f'07220{i % size:05d}')
+        else:
+            numbers.append(f'+40733{i:05d}')
+    return numbers
+
+def scan(allowed, number):
+    suffix = number[-caller_index.SIGNIFICANT_DIGITS:]
+    for saved in allowed:
+        if saved.endswith(suffix):
+            return True
+    return False
+
+def measure(contains, numbers):
+    start = time.ticks_us()
+    for number in numbers:
+        contains(number)
+    return time.ticks_diff(time.ticks_us(), start) * 1000 // len(numbers)
+
+def run():
+    if tracemalloc and not hasattr(gc, 'mem_alloc'):
+        tracemalloc.start()
+
+    for size in SIZES:
+        numbers = queries(size)
+
+        before = heap()
+        allowed = callers(size)
+        dict_bytes = heap() - before
+        dict_ns = measure(lambda number: number in allowed, numbers)
+        scan_ns = measure(lambda number: scan(allowed, number), numbers[:SCAN_LOOKUPS])
+
+        before = heap()
+        caller_index.build(allowed.keys())
+        index_bytes = heap() - before
+        index_ns = measure(caller_index.contains, numbers)
+
+        print(f'{size} callers: dict {dict_bytes} bytes, exact {dict_ns / 1000:.2f} us/lookup, scan {scan_ns / 1000:.2f} us/lookup; '
+            f'index {index_bytes} bytes, {index_ns / 1000:.2f} us/lookup, built in {caller_index.stats["build_ms"]} ms')
+        caller_index.build(())
+        del allowed
+
+caller_index.print = lambda *args: None
+run()
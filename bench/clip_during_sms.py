@@ -0,0 +1,72 @@
+import host
+import sys
+import time
+import uasyncio as asyncio
+import dynamic_queue
+
+# +CLIP handling latency while an SMS is being read: the modem takes
+# SMS_COMMAND_MS to answer each SMS command, the +CLIP arrives while
+# AT+CMGF is in flight, followed by a burst of call progress lines. The
+# call must reach the device queue and be hung up before AT+CMGR is sent
+SMS_COMMAND_MS = 300
+MAX_LATENCY_MS = SMS_COMMAND_MS + 100
+ROUNDS = 5
+
+modem = host.Modem({
+    'ATH': 'OK\r\n',
+    'AT+CMGF=1': 'OK\r\n',
+    'AT+CMGR=3': '+CMGR: "REC UNREAD","0722000009"\r\nhello\r\n\r\nOK\r\n'
+}, delays = {'AT+CMG': SMS_COMMAND_MS})
+called = asyncio.Event()
+
+async def device(sim800l):
+    while True:
+        event = await sim800l.device_queue.get()
+        if event['event'] == 'incoming-call':
+            called.set()
+            asyncio.create_task(sim800l.open_gate('0700000000', event['caller']))
+
+def commands():
+    return [command for _, command in modem.log]
+
+async def run():
+    sim800l = host.start_modem(modem)
+    sim800l.print = lambda *args: None
+    asyncio.create_task(device(sim800l))
+
+    latencies = []
+    failed = False
+    for i in range(ROUNDS):
+        del modem.log[:]
+        called.clear()
+        modem.urc('+CMTI: "SM",3\r\n')
+        await asyncio.sleep_ms(50)
+
+        start = time.ticks_ms()
+        modem.urc(f'RING\r\n+CLIP: "07220000{i:02d}",129,"",0,"",0\r\n' + 'MO RING\r\nNO CARRIER\r\n' * 10)
+        try:
+            await asyncio.wait_for(called.wait(), 2)
+            latencies.append(time.ticks_diff(time.ticks_ms(), start))
+        except asyncio.TimeoutError:
+            print('+CLIP not handled')
+            failed = True
+
+        while 'AT+CMGR=3' not in commands() or sim800l.is_busy():
+            await asyncio.sleep_ms(10)
+        log = commands()
+        if 'ATH' not in log or log.index('ATH') > log.index('AT+CMGR=3'):
+            print('Call hung up after the SMS read', log)
+            failed = True
+        # Lets the +CLIP dedup window pass before the next caller
+        await asyncio.sleep_ms(100)
+
+    host.report('+CLIP to incoming-call during SMS read', latencies, 'ms')
+    for name, stats in dynamic_queue.stats().items():
+        if name.startswith('urc'):
+            print(name, stats)
+    if failed or not latencies or max(latencies) > MAX_LATENCY_MS:
+        print('FAIL')
+        sys.exit(1)
+    print('OK')
+
+asyncio.run(run())
@@ -0,0 +1,49 @@
+import host
+import time
+import uasyncio as asyncio
+from dynamic_queue import Queue, DROP_OLDEST
+
+# Time from an incoming-call event being put in device_queue to the enable
+# pin being driven, with the consumer task main.py uses and with the 50 ms
+# polling loop it replaced
+ROUNDS = 200
+POLL_MS = 50
+CALLER = '0722000001'
+
+main = host.load_main()
+main.state['allowed_callers'] = {CALLER: 'bench'}
+main.caller_index.build(main.state['allowed_callers'])
+
+async def open_gate(gate_number, caller):
+    pass
+
+main.sim800l.open_gate = open_gate
+
+async def polling(queue, handler):
+    while True:
+        if not queue.empty():
+            await handler(queue.get_nowait())
+        await asyncio.sleep_ms(POLL_MS)
+
+async def measure(consumer):
+    queue = Queue(24, DROP_OLDEST)
+    main.device_queue = queue
+    task = asyncio.create_task(consumer(queue, main.handle_device_event))
+    latencies = []
+    for i in range(ROUNDS):
+        count = main.gate_latency['count']
+        queue.put_nowait({'event': 'incoming-call', 'code': '+CLIP', 'caller': CALLER, 'received_us': time.ticks_us(), 'gate_opened': False})
+        while main.gate_latency['count'] == count:
+            await asyncio.sleep_ms(0)
+        latencies.append(main.gate_latency['last_us'])
+        # Lands anywhere in the polling period
+        await asyncio.sleep_ms(i % POLL_MS)
+    task.cancel()
+    return latencies
+
+async def run():
+    host.report('consumer task', await measure(main.dispatch))
+    host.report(f'{POLL_MS} ms polling', await measure(polling))
+
+main.print = lambda *args: None
+asyncio.run(run())
@@ -0,0 +1,54 @@
+import host
+import time
+import webserver
+
+# Parses the form the admin page posts for a 500 entry allowed callers
+# list. legacy() is the parser webserver.py used before: a str built one
+# character at a time, the whole body decoded and then each value twice more
+CALLERS = 500
+ROUNDS = 20
+
+def legacy_url_decode(encoded):
+    decoded = ''
+    i = 0
+    while i < len(encoded):
+        c = encoded[i]
+        if c == '%' and i + 2 < len(encoded):
+            decoded += chr(int(encoded[i + 1:i + 3], 16))
+            i += 3
+            continue
+        decoded += ' ' if c == '+' else c
+        i += 1
+    return decoded
+
+def legacy(body):
+    data = {}
+    for pair in legacy_url_decode(body.decode('utf8')).split('&'):
+        segments = pair.split('=')
+        key = segments.pop(0)
+        value = legacy_url_decode(legacy_url_decode('='.join(segments)).strip())
+        if '[]' in key:
+            data.setdefault(key[0:-2], []).append(value)
+        else:
+            data[key] = value
+    return data
+
+def form(count):
+    fields = []
+    for i in range(count):
+        fields.append(f'name%5B%5D=Locatar+%C8%98tefan+{i}&phone%5B%5D=%2B40722{i:06d}')
+    return '&'.join(fields).encode('ascii')
+
+def measure(name, parse, body):
+    start = time.ticks_us()
+    for _ in range(ROUNDS):
+        data = parse(body)
+    elapsed = time.ticks_diff(time.ticks_us(), start) // ROUNDS
+    print(f'{name}: {elapsed / 1000:.1f} ms per form, {len(data["phone"])} callers')
+    return data
+
+body = form(CALLERS)
+print(f'{CALLERS} callers, {len(body)} bytes')
+measure('legacy', legacy, body)
+data = measure('single pass', webserver.parse_form_data, body)
+assert data['name'][1] == 'Locatar Ștefan 1' and data['phone'][1] == '+40722000001'
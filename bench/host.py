@@ -0,0 +1,165 @@
+import sys
+import os
+import time
+import gc
+
+# Runs the firmware modules on a PC, under CPython or the MicroPython unix
+# port. Only what the board provides is stood in for: the rp2 machine and
+# network modules, the MicroPython time and gc helpers and the primitives
+# setup.sh copies into src/lib
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC = os.path.join(ROOT, 'src')
+PRIMITIVES = os.path.join(ROOT, 'lib', 'micropython-async', 'v3')
+
+sys.path.insert(0, SRC)
+
+try:
+    import uasyncio
+except ImportError:
+    import asyncio
+    async def sleep_ms(ms):
+        await asyncio.sleep(ms / 1000)
+    asyncio.sleep_ms = sleep_ms
+    sys.modules['uasyncio'] = asyncio
+
+import uasyncio as asyncio
+
+if not hasattr(time, 'ticks_ms'):
+    time.ticks_ms = lambda: int(time.monotonic() * 1000)
+    time.ticks_us = lambda: int(time.monotonic() * 1000000)
+    time.ticks_diff = lambda a, b: a - b
+    time.ticks_add = lambda a, b: a + b
+
+if not hasattr(gc, 'mem_free'):
+    gc.mem_free = lambda: 0
+
+def module(name, **attrs):
+    m = type(sys)(name)
+    for key in attrs:
+        setattr(m, key, attrs[key])
+    sys.modules[name] = m
+    return m
+
+if not os.path.isdir(os.path.join(SRC, 'lib')):
+    module('lib').__path__ = [PRIMITIVES]
+
+class Pin():
+    OUT = 1
+    IN = 0
+
+    def __init__(self, *args):
+        self.value = 0
+
+    def high(self):
+        self.value = 1
+
+    def low(self):
+        self.value = 0
+
+    def toggle(self):
+        self.value ^= 1
+
+class WDT():
+
+    def __init__(self, timeout = 0):
+        self.timeout = timeout
+        self.fed = time.ticks_ms()
+
+    def feed(self):
+        self.fed = time.ticks_ms()
+
+def reset():
+    raise SystemExit('machine.reset()')
+
+class UART():
+    pass
+
+if 'machine' not in sys.modules:
+    module('machine', Pin=Pin, WDT=WDT, UART=UART, reset=reset)
+
+if 'network' not in sys.modules:
+    module('network', STA_IF=0, STAT_IDLE=0, STAT_CONNECTING=1, STAT_WRONG_PASSWORD=-3,
+        STAT_NO_AP_FOUND=-2, STAT_CONNECT_FAIL=-1, STAT_GOT_IP=3)
+
+if not os.path.exists(os.path.join(SRC, 'phone_numbers.py')):
+    module('phone_numbers', GATE_NUMBER='0700000000', OWNER_NUMBER='0700000001', ALLOWED_CALLERS={})
+
+def load_main():
+    # main.py starts the firmware when it is imported, only its definitions
+    # are loaded here
+    with open(os.path.join(SRC, 'main.py')) as file:
+        source = file.read()
+    source = source[:source.rindex('asyncio.run(main())')]
+    main = module('main')
+    exec(compile(source, 'main.py', 'exec'), main.__dict__)
+    return main
+
+class Modem():
+    # Scripted SIM800: answers the commands it knows after a delay, lines
+    # pushed with urc() are read as if the modem sent them
+    def __init__(self, responses, delay_ms = 10, delays = None):
+        self.responses = responses
+        self.delay_ms = delay_ms
+        self.delays = delays or {}
+        self.buf = bytearray()
+        self.ready = asyncio.Event()
+        self.log = []
+
+    def delay(self, command):
+        for prefix in self.delays:
+            if command.startswith(prefix):
+                return self.delays[prefix]
+        return self.delay_ms
+
+    def write(self, data):
+        command = bytes(data).decode().strip()
+        self.log.append((time.ticks_ms(), command))
+        response = self.responses.get(command)
+        if response is None:
+            return
+        asyncio.create_task(self.answer(command, response, self.delay(command)))
+
+    async def answer(self, command, response, delay):
+        await asyncio.sleep_ms(delay)
+        self.urc(command + '\r\r\n' + response)
+
+    def urc(self, text):
+        self.buf.extend(text.encode())
+        self.ready.set()
+
+    async def drain(self):
+        pass
+
+    async def readinto(self, mv):
+        while not self.buf:
+            self.ready.clear()
+            await self.ready.wait()
+        n = min(len(mv), len(self.buf))
+        mv[:n] = self.buf[:n]
+        self.buf = self.buf[n:]
+        return n
+
+def start_modem(modem):
+    import sim800l
+    from dynamic_queue import Queue
+    from uart import LineReader, Frame
+
+    sim800l.device_queue = Queue(24)
+    sim800l.debug_queue = Queue(24)
+    sim800l.writer = modem
+    sim800l.line_reader = LineReader(modem)
+    sim800l.frames = (Frame(), Frame())
+    sim800l.response_frame = sim800l.frames[0]
+    sim800l.watchdog = WDT()
+    for task in (sim800l.do_write, sim800l.do_read, sim800l.handle_urc, sim800l.serve_calls, sim800l.call_state.run):
+        asyncio.create_task(task())
+    for queue in (sim800l.call_urcs, sim800l.power_urcs, sim800l.sms_urcs):
+        asyncio.create_task(sim800l.urc_worker(queue))
+    return sim800l
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def report(name, values, unit = 'us'):
+    print(f'{name}: n={len(values)} min={min(values)}{unit} p50={percentile(values, 50)}{unit} p99={percentile(values, 99)}{unit} max={max(values)}{unit}')
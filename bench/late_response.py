@@ -0,0 +1,35 @@
+import host
+import sys
+import uasyncio as asyncio
+
+# A command that times out must not hand its late answer to the commands
+# queued after it: AT+SLOW answers after its 1 s timeout, while AT+CSQ is
+# in flight, and every command after it must still get its own response
+modem = host.Modem({
+    'AT+SLOW': '+SLOW: 1\r\nOK\r\n',
+    'AT+CSQ': '+CSQ: 20,0\r\nOK\r\n',
+    'AT+COPS?': '+COPS: 0,0,"NETWORK"\r\nOK\r\n'
+}, delays = {'AT+SLOW': 1300, 'AT+CSQ': 500})
+
+async def run():
+    sim800l = host.start_modem(modem)
+    sim800l.print = lambda *args: None
+
+    expected = [
+        ('AT+SLOW', ('timeout', 'UNKNOWN', None)),
+        ('AT+CSQ', ('ok', 'OK', '+CSQ: 20,0')),
+        ('AT+COPS?', ('ok', 'OK', '+COPS: 0,0,"NETWORK"')),
+        ('AT+CSQ', ('ok', 'OK', '+CSQ: 20,0'))
+    ]
+    failed = False
+    for command, result in expected:
+        got = await sim800l.send(command)
+        print(command, got)
+        if got != result:
+            print('expected', result)
+            failed = True
+
+    print('FAIL' if failed else 'OK')
+    sys.exit(1 if failed else 0)
+
+asyncio.run(run())
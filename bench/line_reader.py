@@ -0,0 +1,121 @@
+import host
+import gc
+import time
+import uasyncio as asyncio
+import sim800l
+from uart import LineReader, Frame
+
+# Heap allocated per modem line by the reader path: uart.LineReader and
+# the URC table lookup do_read() runs, against the readline() + decode()
+# + split() path it replaced. Each line that isn't a URC goes into the
+# response, the way do_read() builds it. Allocations are only counted by
+# the unix port (gc.mem_alloc), CPython reports the line rate alone
+TRANSCRIPT = b'''AT+CPIN?;+COPS?;+CSQ\r
+\r
++CPIN: READY\r
++COPS: 0,0,"RO ORANGE"\r
++CSQ: 17,0\r
+\r
+OK\r
+\r
+RING\r
+\r
++CLIP: "+40722000001",145,"",0,"",0\r
+ATH\r
+OK\r
+\r
++CDRIND: 0\r
+\r
++CMTI: "SM",1\r
+AT+CMGR=1\r
+\r
++CMGR: "REC UNREAD","+40722000001","","24/05/01,08:15:02+12"\r
+Open the gate for the courier, he will be there in ten minutes\r
+\r
+OK\r
+\r
+MO RING\r
+\r
+NO CARRIER\r
+'''
+LINES = len([line for line in TRANSCRIPT.split(b'\n') if line.strip()])
+ROUNDS = 200
+URC = ['+CLIP', '+CPIN', 'SMS Ready', 'Call Ready', '+CMTI', '+CDRIND', 'RING', 'MO RING', 'MO CONNECTED',
+    'BUSY', 'NO CARRIER', 'NO DIALTONE', 'NO ANSWER', 'NORMAL POWER DOWN', 'UNDER-VOLTAGE POWER DOWN',
+    'UNDER-VOLTAGE WARNING', 'OVER-VOLTAGE POWER DOWN', 'OVER-VOLTAGE WARNING', 'CHARGE-ONLY MODE', 'RDY']
+
+class Stream():
+    # Hands out the transcript ROUNDS times. readinto() fills the reader's
+    # buffer a chunk at a time like the UART driver, its one memoryview
+    # slice per chunk is spread over the lines in it
+    def __init__(self):
+        self.mv = memoryview(TRANSCRIPT)
+        self.pos = 0
+        self.left = ROUNDS
+
+    def rewind(self):
+        if self.pos == len(TRANSCRIPT):
+            self.pos = 0
+            self.left -= 1
+        return self.left > 0
+
+    async def readinto(self, mv):
+        if not self.rewind():
+            return 0
+        n = min(len(mv), len(TRANSCRIPT) - self.pos)
+        mv[:n] = self.mv[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    async def readline(self):
+        if not self.rewind():
+            return b''
+        end = TRANSCRIPT.index(b'\n', self.pos) + 1
+        line = TRANSCRIPT[self.pos:end]
+        self.pos = end
+        return line
+
+async def legacy(stream, count):
+    line_buffer = []
+    for _ in range(count):
+        line = ''
+        while not line:
+            line = (await stream.readline()).decode('utf8').strip()
+        if line.split(':').pop(0) in URC:
+            continue
+        line_buffer.append(line)
+        if line == 'OK' or line == 'ERROR' or '+CME ERROR' in line or '+CMS ERROR' in line:
+            line_buffer = []
+
+async def reader(stream, count):
+    line_reader = LineReader(stream)
+    frame = Frame()
+    for _ in range(count):
+        line = await line_reader.readline()
+        code = sim800l.line_code(line)
+        if sim800l.classify_urc(code):
+            continue
+        frame.append(line)
+        if code in sim800l.FINAL_RESULT_CODES:
+            frame.clear()
+
+async def measure(name, path):
+    count = LINES * (ROUNDS - 1)
+    start = time.ticks_us()
+    await path(Stream(), count)
+    elapsed = time.ticks_diff(time.ticks_us(), start)
+    print(f'{name}: {count * 1000000 // elapsed} lines/s')
+
+    if hasattr(gc, 'mem_alloc'):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        await path(Stream(), count)
+        print(f'{name}: {(gc.mem_alloc() - before) // count} heap bytes/line')
+        gc.enable()
+
+async def run():
+    await measure('readline + decode', legacy)
+    await measure('LineReader + URC table', reader)
+
+asyncio.run(run())
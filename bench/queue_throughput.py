@@ -0,0 +1,50 @@
+import host
+import time
+import uasyncio as asyncio
+from dynamic_queue import Queue, DROP_OLDEST, DROP_NEWEST, BLOCK
+from lib.primitives.queue import Queue as ListQueue
+
+# put/get throughput of dynamic_queue.Queue for each overflow policy,
+# against the list backed primitives Queue it replaced
+ITEMS = 100000
+DEPTH = 24
+
+def nowait(queue, depth):
+    start = time.ticks_us()
+    for i in range(ITEMS // depth):
+        for j in range(depth):
+            queue.put_nowait(j)
+        for j in range(depth):
+            queue.get_nowait()
+    return time.ticks_diff(time.ticks_us(), start)
+
+async def producer(queue):
+    for i in range(ITEMS):
+        await queue.put(i)
+
+async def consumer(queue):
+    for i in range(ITEMS):
+        await queue.get()
+
+async def tasks(queue):
+    start = time.ticks_us()
+    await asyncio.gather(producer(queue), consumer(queue))
+    return time.ticks_diff(time.ticks_us(), start)
+
+def report(name, elapsed):
+    print(f'{name}: {ITEMS * 1000000 // elapsed} items/s')
+
+async def run():
+    for name, policy in (('drop-oldest', DROP_OLDEST), ('drop-newest', DROP_NEWEST), ('block', BLOCK)):
+        report(f'{name} put_nowait/get_nowait', nowait(Queue(DEPTH, policy), DEPTH))
+    report('list queue put_nowait/get_nowait', nowait(ListQueue(DEPTH), DEPTH))
+
+    report('block put/get between tasks', await tasks(Queue(DEPTH, BLOCK)))
+    report('list queue put/get between tasks', await tasks(ListQueue(DEPTH)))
+
+    queue = Queue(DEPTH, DROP_OLDEST)
+    for i in range(ITEMS):
+        queue.put_nowait(i)
+    print(f'drop-oldest overflow: {queue.drops} drops, oldest kept {queue.get_nowait()}')
+
+asyncio.run(run())
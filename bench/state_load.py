@@ -0,0 +1,109 @@
+import host
+import gc
+import os
+import json
+import time
+import state_store
+
+# Boot time and peak heap of loading the state from the binary snapshot,
+# against reading state.json and json.loads() as boot did before, for a
+# growing caller list. The snapshot decodes a field the first time it is
+# read, the boot that reads allowed_callers to build the index is timed
+# apart. Peak heap comes from tracemalloc on CPython. The unix port counts
+# every byte allocated with the collector off, an upper bound of the peak
+SIZES = (100, 1000, 4000)
+DIR = 'state_load.tmp'
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+def defaults(size):
+    return {
+        'gate_number': '0700000000',
+        'owner_number': '0700000001',
+        'ep_toggle_duration': 500,
+        'fast_path': False,
+        'caller_db': False,
+        'allowed_callers': {f'07220{i:05d}': f'Caller {i}' for i in range(size)},
+        'ssid': 'gate',
+        'ssid_password': 'password'
+    }
+
+def measure(load):
+    gc.collect()
+    if hasattr(gc, 'mem_alloc'):
+        gc.disable()
+        before = gc.mem_alloc()
+        start = time.ticks_us()
+        state = load()
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        peak = gc.mem_alloc() - before
+        gc.enable()
+    else:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.ticks_us()
+        state = load()
+        elapsed = time.ticks_diff(time.ticks_us(), start)
+        peak = tracemalloc.get_traced_memory()[1] - before
+    return state, elapsed, peak
+
+def load_json():
+    with open(state_store.LEGACY_FILE, 'r') as file:
+        return json.loads(file.read())
+
+def load_snapshot():
+    return state_store.load({})
+
+def load_snapshot_callers():
+    state = state_store.load({})
+    state['allowed_callers']
+    return state
+
+def remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+def run():
+    if tracemalloc and not hasattr(gc, 'mem_alloc'):
+        tracemalloc.start()
+
+    for size in SIZES:
+        state = defaults(size)
+        with open(state_store.LEGACY_FILE, 'w') as file:
+            file.write(json.dumps(state))
+        json_size = os.stat(state_store.LEGACY_FILE)[6]
+        state_store.state = state_store.State(state)
+        state_store.compact()
+        snapshot_size = os.stat(state_store.SNAPSHOT_FILE)[6]
+        del state
+
+        loaded, json_us, json_peak = measure(load_json)
+        del loaded
+        # Boot removes state.json once the snapshot is read
+        loaded, snapshot_us, snapshot_peak = measure(load_snapshot)
+        del loaded
+        loaded, callers_us, callers_peak = measure(load_snapshot_callers)
+        assert len(loaded['allowed_callers']) == size
+        del loaded
+
+        print(f'{size} callers: json {json_size} bytes {json_us} us peak {json_peak} bytes; '
+            f'snapshot {snapshot_size} bytes {snapshot_us} us peak {snapshot_peak} bytes, '
+            f'with allowed_callers {callers_us} us peak {callers_peak} bytes')
+
+    for filename in (state_store.SNAPSHOT_FILE, state_store.LEGACY_FILE, state_store.JOURNAL_FILE):
+        remove(filename)
+
+try:
+    os.mkdir(DIR)
+except OSError:
+    pass
+os.chdir(DIR)
+state_store.print = lambda *args: None
+run()
+os.chdir('..')
+os.rmdir(DIR)
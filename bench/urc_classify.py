@@ -0,0 +1,82 @@
+import host
+import gc
+import time
+import sim800l
+
+# Lines/sec classifying a SIM800 transcript: status polling, a ring storm
+# and an SMS burst. legacy() is the classification do_read() did before
+# the URC table: split the line up to three times and scan two lists
+TRANSCRIPT = '''AT+CPIN?;+COPS?;+CSQ
++CPIN: READY
++COPS: 0,0,"RO ORANGE"
++CSQ: 17,0
+OK
+RING
++CLIP: "+40722000001",145,"",0,"",0
+RING
++CLIP: "+40722000001",145,"",0,"",0
+RING
++CLIP: "+40722000002",145,"",0,"",0
+ATH
+OK
++CDRIND: 0
++CMTI: "SM",1
++CMTI: "SM",2
+AT+CMGR=1
++CMGR: "REC UNREAD","+40722000001","","24/05/01,08:15:02+12"
+Open the gate for the courier, he will be there in ten minutes
+OK
+MO RING
+MO CONNECTED
+NO CARRIER
+UNDER-VOLTAGE WARNING
+Call Ready
+SMS Ready
+'''.split('\n')
+
+URC = ['+CLIP', '+CPIN', 'SMS Ready', 'Call Ready', '+CMTI', '+CDRIND', 'RING', 'MO RING', 'MO CONNECTED',
+    'BUSY', 'NO CARRIER', 'NO DIALTONE', 'NO ANSWER', 'NORMAL POWER DOWN', 'UNDER-VOLTAGE POWER DOWN',
+    'UNDER-VOLTAGE WARNING', 'OVER-VOLTAGE POWER DOWN', 'OVER-VOLTAGE WARNING', 'CHARGE-ONLY MODE', 'RDY']
+IGNORED = ['RING', '+CPIN', 'SMS Ready', 'Call Ready', 'CHARGE-ONLY MODE', 'RDY']
+last_command = None
+
+def legacy(raw):
+    line = raw.decode('utf8').strip()
+    code = line.split(':').pop(0)
+    if code in ('+CDRIND', 'BUSY', 'NO CARRIER', 'NO ANSWER', 'NO DIALTONE') and last_command == 'ATH':
+        return None
+    if code == '+CPIN' and last_command == 'AT+CPIN?':
+        return None
+    if code not in URC:
+        return None
+    if line.split(':').pop(0) in IGNORED:
+        return None
+    segments = line.split(':')
+    return segments.pop(0), ':'.join(segments)
+
+def table(line):
+    code = sim800l.line_code(line)
+    return sim800l.classify_urc(code)
+
+def measure(name, classify, lines, rounds):
+    start = time.ticks_us()
+    for _ in range(rounds):
+        for line in lines:
+            classify(line)
+    elapsed = time.ticks_diff(time.ticks_us(), start)
+    print(f'{name}: {len(lines) * rounds * 1000000 // elapsed} lines/s')
+
+    # Heap used per line, only the unix port reports it
+    if hasattr(gc, 'mem_alloc'):
+        gc.collect()
+        gc.disable()
+        before = gc.mem_alloc()
+        for line in lines:
+            classify(line)
+        print(f'{name}: {(gc.mem_alloc() - before) // len(lines)} heap bytes/line')
+        gc.enable()
+
+lines = [line.encode() for line in TRANSCRIPT if line]
+views = [memoryview(line) for line in lines]
+measure('legacy', legacy, lines, 2000)
+measure('urc table', table, views, 2000)
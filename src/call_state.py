@@ -0,0 +1,152 @@
+import uasyncio as asyncio
+import time
+
+IDLE = 'idle'
+# Incoming call admitted, waiting for main to open the gate or decline
+INCOMING = 'incoming'
+# Outgoing call to the gate, waiting for it to ring
+DIALING = 'dialing'
+RINGING = 'ringing'
+# The gate rang long enough, the call can be hung up
+GATE_OK = 'gate-ok'
+HANGING_UP = 'hanging-up'
+
+# (state, event) -> next state. Events that aren't listed for the current
+# state are ignored
+TRANSITIONS = {
+    (IDLE, 'incoming'): INCOMING,
+    (IDLE, 'dial'): DIALING,
+    (INCOMING, 'hangup'): HANGING_UP,
+    (INCOMING, 'end'): IDLE,
+    (INCOMING, 'timeout'): IDLE,
+    (INCOMING, 'abandon'): IDLE,
+    (DIALING, 'ring'): RINGING,
+    (DIALING, 'rejected'): IDLE,
+    (DIALING, 'end'): IDLE,
+    (DIALING, 'timeout'): IDLE,
+    (RINGING, 'timeout'): GATE_OK,
+    (RINGING, 'rejected'): IDLE,
+    (RINGING, 'end'): IDLE,
+    (GATE_OK, 'hangup'): HANGING_UP,
+    (GATE_OK, 'rejected'): IDLE,
+    (GATE_OK, 'end'): IDLE,
+    (HANGING_UP, 'end'): IDLE,
+    (HANGING_UP, 'timeout'): IDLE,
+    (HANGING_UP, 'abandon'): IDLE
+}
+
+TRACE_SIZE = 32
+
+class CallStateMachine():
+    # Owns everything about the call the modem is on: state, direction and
+    # number. States listed in timeouts get a 'timeout' event that many ms
+    # after they are entered. Modem work that isn't a call (SMS, credit
+    # checks) is only counted, so the status polling can wait for all of
+    # it to finish
+
+    def __init__(self, timeouts, transitions = TRANSITIONS):
+        self.transitions = transitions
+        self.timeouts = timeouts
+        self.state = IDLE
+        self.direction = None
+        self.number = None
+        # Last event handled and the URC that came with it, if any
+        self.event = None
+        self.detail = None
+        self.operations = 0
+        self.deadline = None
+        self.changed = asyncio.Event()
+        self._rearm = asyncio.Event()
+        # (ticks, from, event, to, detail) ring
+        self._trace = [None] * TRACE_SIZE
+        self._traced = 0
+
+    def handle(self, event, detail = None):
+        next_state = self.transitions.get((self.state, event))
+        if next_state is None:
+            return False
+
+        self._traced += 1
+        self._trace[self._traced % TRACE_SIZE] = (time.ticks_ms(), self.state, event, next_state, detail)
+        if self.state == IDLE:
+            self.detail = None
+        if detail is not None:
+            self.detail = detail
+        self.event = event
+        if next_state == self.state:
+            return True
+
+        self.state = next_state
+        timeout = self.timeouts.get(next_state)
+        self.deadline = time.ticks_add(time.ticks_ms(), timeout) if timeout else None
+        if next_state == IDLE:
+            self.direction = None
+            self.number = None
+
+        self._rearm.set()
+        self.changed.set()
+        self.changed.clear()
+        return True
+
+    def incoming(self, number):
+        if self.handle('incoming'):
+            self.direction = 'incoming'
+            self.number = number
+            return True
+        return False
+
+    def dial(self, number):
+        if self.handle('dial'):
+            self.direction = 'outgoing'
+            self.number = number
+            return True
+        return False
+
+    def begin_operation(self):
+        self.operations += 1
+
+    def end_operation(self):
+        self.operations -= 1
+        self.changed.set()
+        self.changed.clear()
+
+    def idle(self):
+        return self.state == IDLE and not self.operations
+
+    async def wait_for(self, states):
+        while self.state not in states:
+            await self.changed.wait()
+        return self.state
+
+    async def wait_idle(self):
+        while not self.idle():
+            await self.changed.wait()
+
+    async def run(self):
+        # Fires the timed transitions
+        while True:
+            self._rearm.clear()
+            if self.deadline is None:
+                await self._rearm.wait()
+                continue
+
+            remaining = time.ticks_diff(self.deadline, time.ticks_ms())
+            if remaining <= 0:
+                self.deadline = None
+                self.handle('timeout')
+                continue
+
+            try:
+                await asyncio.wait_for(self._rearm.wait(), remaining / 1000)
+            except asyncio.TimeoutError:
+                pass
+
+    def trace(self):
+        first = max(1, self._traced - TRACE_SIZE + 1)
+        return [self._trace[i % TRACE_SIZE] for i in range(first, self._traced + 1)]
+
+    def describe(self):
+        lines = [f'{self.state} {self.direction or ""} {self.number or ""} ops={self.operations}']
+        for (ticks, from_state, event, to_state, detail) in self.trace()[-8:]:
+            lines.append(f'  {ticks} {from_state} --{event}--> {to_state} {detail or ""}')
+        return '\n'.join(lines)
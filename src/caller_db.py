@@ -0,0 +1,328 @@
+import uasyncio as asyncio
+import os
+import struct
+import caller_index
+
+# Fixed width records sorted by normalized number:
+# key (uint32) | number (ascii, zero padded) | name (utf8, zero padded)
+DB_FILE = 'callers.db'
+TMP_FILE = 'callers.tmp'
+# Written when the database is enabled, apart from the file a merge may
+# still be writing
+SEED_FILE = 'callers.seed'
+# Pending adds and removes, same record layout. An empty number marks a removal
+DELTA_FILE = 'callers.delta'
+DELTA_TMP_FILE = 'callers.delta.tmp'
+NUMBER_SIZE = 16
+NAME_SIZE = 28
+RECORD_SIZE = 4 + NUMBER_SIZE + NAME_SIZE
+# Reaching this many pending entries wakes the background merge
+MAX_DELTA_ENTRIES = 32
+# Records copied between yields to the event loop while merging
+MERGE_BATCH = 32
+PAGE_SIZE = 20
+
+enabled = False
+# Bumped every time the database is opened or closed, a merge started
+# before that is abandoned
+generation = 0
+# key -> (number, name), None for removed callers
+delta = {}
+merge_event = asyncio.Event()
+# Records are read into one buffer and packed into another, so a merge
+# can write pending records while holding the one it just read
+record = bytearray(RECORD_SIZE)
+record_mv = memoryview(record)
+packed = bytearray(RECORD_SIZE)
+
+def fit(text, size):
+    data = text.encode('utf8')
+    while len(data) > size:
+        text = text[:-1]
+        data = text.encode('utf8')
+    return data
+
+def field(start, size):
+    value = bytes(record_mv[start:start + size])
+    end = value.find(b'\0')
+    if end != -1:
+        value = value[:end]
+    try:
+        return str(value, 'utf8')
+    except:
+        return ''
+
+def record_key(buf):
+    return struct.unpack_from('<I', buf, 0)[0]
+
+def pack(key, number, name):
+    for i in range(RECORD_SIZE):
+        packed[i] = 0
+    struct.pack_into('<I', packed, 0, key)
+    number = fit(number, NUMBER_SIZE)
+    packed[4:4 + len(number)] = number
+    name = fit(name, NAME_SIZE)
+    packed[4 + NUMBER_SIZE:4 + NUMBER_SIZE + len(name)] = name
+    return packed
+
+def unpack():
+    return field(4, NUMBER_SIZE), field(4 + NUMBER_SIZE, NAME_SIZE)
+
+def exists(filename):
+    try:
+        os.stat(filename)
+        return True
+    except OSError:
+        return False
+
+def record_count():
+    try:
+        return os.stat(DB_FILE)[6] // RECORD_SIZE
+    except OSError:
+        return 0
+
+def load_delta():
+    delta.clear()
+    try:
+        with open(DELTA_FILE, 'rb') as file:
+            while file.readinto(record) == RECORD_SIZE:
+                number, name = unpack()
+                delta[record_key(record)] = (number, name) if number else None
+    except OSError:
+        pass
+
+def seed(callers):
+    records = []
+    for number, name in callers.items():
+        key = caller_index.normalize(number)
+        if key is not None:
+            records.append((key, number, name))
+    records.sort()
+
+    with open(SEED_FILE, 'wb') as file:
+        for key, number, name in records:
+            file.write(pack(key, number, name))
+    os.rename(SEED_FILE, DB_FILE)
+    remove_file(DELTA_FILE)
+
+def open_db(callers, replace = False):
+    global enabled
+    global generation
+    # While the database is enabled it is the only copy of the callers. It
+    # starts from the callers kept in the state when it is switched on
+    if replace or not exists(DB_FILE):
+        seed(callers)
+
+    generation += 1
+    load_delta()
+    enabled = True
+    if len(delta) >= MAX_DELTA_ENTRIES:
+        merge_event.set()
+    print('Caller database:', record_count(), 'records,', len(delta), 'pending')
+
+def close_db():
+    global enabled
+    global generation
+    generation += 1
+    enabled = False
+    delta.clear()
+
+def remove_file(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+def clear():
+    close_db()
+    for filename in (DB_FILE, DELTA_FILE, TMP_FILE, DELTA_TMP_FILE, SEED_FILE):
+        remove_file(filename)
+
+def search(key):
+    # Binary search reading one record per step
+    lo = 0
+    hi = record_count() - 1
+    try:
+        with open(DB_FILE, 'rb') as file:
+            while lo <= hi:
+                mid = (lo + hi) // 2
+                file.seek(mid * RECORD_SIZE)
+                if file.readinto(record) != RECORD_SIZE:
+                    return None
+
+                found = record_key(record)
+                if found == key:
+                    return unpack()
+                if found < key:
+                    lo = mid + 1
+                else:
+                    hi = mid - 1
+    except OSError:
+        pass
+    return None
+
+def lookup(number):
+    key = caller_index.normalize(number)
+    if key is None:
+        return None
+
+    if key in delta:
+        return delta[key]
+    return search(key)
+
+def append_delta(key, number, name):
+    with open(DELTA_FILE, 'ab') as file:
+        file.write(pack(key, number, name))
+
+def add(name, number):
+    key = caller_index.normalize(number)
+    if key is None:
+        return False
+
+    append_delta(key, number, name)
+    delta[key] = (number, name)
+    if len(delta) >= MAX_DELTA_ENTRIES:
+        merge_event.set()
+    return True
+
+def remove(number):
+    key = caller_index.normalize(number)
+    if key is None:
+        return False
+
+    append_delta(key, '', '')
+    delta[key] = None
+    if len(delta) >= MAX_DELTA_ENTRIES:
+        merge_event.set()
+    return True
+
+def write_pending(file, item):
+    key, value = item
+    if value is not None:
+        file.write(pack(key, value[0], value[1]))
+
+def write_delta():
+    if not delta:
+        remove_file(DELTA_FILE)
+        return
+
+    with open(DELTA_TMP_FILE, 'wb') as file:
+        for key, value in delta.items():
+            if value is None:
+                file.write(pack(key, '', ''))
+            else:
+                file.write(pack(key, value[0], value[1]))
+    os.rename(DELTA_TMP_FILE, DELTA_FILE)
+
+async def merge():
+    if not enabled or not delta:
+        return
+
+    # Lookups keep using the old file and the delta until the new file is
+    # renamed into place. Edits made meanwhile stay pending
+    pending = sorted(delta.items())
+    started = generation
+    i = 0
+    copied = 0
+    with open(DB_FILE, 'rb') as src, open(TMP_FILE, 'wb') as dst:
+        while src.readinto(record) == RECORD_SIZE:
+            key = record_key(record)
+            while i < len(pending) and pending[i][0] < key:
+                write_pending(dst, pending[i])
+                i += 1
+
+            # Superseded by the delta, either replaced or removed
+            if i < len(pending) and pending[i][0] == key:
+                write_pending(dst, pending[i])
+                i += 1
+            else:
+                dst.write(record)
+
+            copied += 1
+            if copied % MERGE_BATCH == 0:
+                await asyncio.sleep_ms(0)
+                if generation != started:
+                    break
+
+        while i < len(pending):
+            write_pending(dst, pending[i])
+            i += 1
+
+    # Closed, cleared or reseeded meanwhile
+    if generation != started:
+        remove_file(TMP_FILE)
+        return
+
+    # The delta is only dropped once the new file is in place, replaying it
+    # after a power cut in between is harmless
+    os.rename(TMP_FILE, DB_FILE)
+    for key, value in pending:
+        if key in delta and delta[key] is value:
+            del delta[key]
+    write_delta()
+
+async def run(on_error):
+    while True:
+        await merge_event.wait()
+        merge_event.clear()
+        try:
+            await merge()
+        except Exception as e:
+            on_error(e)
+
+def page(index, size = PAGE_SIZE):
+    # Walks the file in key order with the delta laid over it, showing a
+    # page never writes to flash
+    pending = sorted(delta.items())
+    first = index * size
+    seen = 0
+    items = []
+    i = 0
+    try:
+        with open(DB_FILE, 'rb') as file:
+            while len(items) < size:
+                key = None
+                if file.readinto(record) == RECORD_SIZE:
+                    key = record_key(record)
+
+                superseded = False
+                while len(items) < size and i < len(pending) and (key is None or pending[i][0] <= key):
+                    pending_key, value = pending[i]
+                    i += 1
+                    if pending_key == key:
+                        superseded = True
+                    if value is not None:
+                        if seen >= first:
+                            items.append(value)
+                        seen += 1
+
+                if key is None:
+                    break
+                if superseded or len(items) >= size:
+                    continue
+                if seen >= first:
+                    items.append(unpack())
+                seen += 1
+    except OSError:
+        pass
+    return items
+
+def callers():
+    # Every caller as (number, name), only read when the database is
+    # switched off and the callers move back into the state
+    return page(0, record_count() + len(delta))
+
+def count():
+    # Records on flash, plus the callers the delta adds and minus the ones
+    # it removes
+    total = record_count()
+    for key, value in delta.items():
+        found = search(key) is not None
+        if value is None and found:
+            total -= 1
+        elif value is not None and not found:
+            total += 1
+    return total
+
+def page_count(size = PAGE_SIZE):
+    return max(1, (count() + size - 1) // size)
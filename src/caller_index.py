@@ -0,0 +1,57 @@
+import gc
+import time
+
+# +CLIP numbers come in as '+40722123456', '0040722123456' or '0722123456'
+# depending on the network. Only the last significant digits are kept, which
+# also keeps every key below 2^30 so it is stored as a small int
+SIGNIFICANT_DIGITS = 9
+MODULUS = 10 ** SIGNIFICANT_DIGITS
+ZERO = 48
+NINE = 57
+
+index = set()
+stats = {
+    'entries': 0,
+    'bytes': 0,
+    'build_ms': 0
+}
+
+def normalize(number):
+    if not number:
+        return None
+
+    value = 0
+    digits = 0
+    for c in number.encode('utf8'):
+        if ZERO <= c <= NINE:
+            # Folded on every digit so no long int is ever allocated
+            value = (value * 10 + c - ZERO) % MODULUS
+            digits += 1
+
+    if not digits:
+        return None
+    return value
+
+def build(numbers):
+    global index
+
+    start = time.ticks_ms()
+    gc.collect()
+    free = gc.mem_free()
+
+    new_index = set()
+    for number in numbers:
+        key = normalize(number)
+        if key is not None:
+            new_index.add(key)
+
+    gc.collect()
+    index = new_index
+    stats['entries'] = len(index)
+    stats['bytes'] = free - gc.mem_free()
+    stats['build_ms'] = time.ticks_diff(time.ticks_ms(), start)
+    print('Caller index:', stats)
+
+def contains(number):
+    key = normalize(number)
+    return key is not None and key in index
@@ -1,15 +1,118 @@
-from lib.primitives.queue import Queue as BaseQueue, QueueEmpty
+import uasyncio as asyncio
+from lib.primitives.ringbuf_queue import RingbufQueue
+from lib.primitives.queue import QueueEmpty, QueueFull
+
+# What put_nowait() does with a full queue
+DROP_OLDEST = 0
+DROP_NEWEST = 1
+BLOCK = 2
+
+# name -> queue, so the counters can be exported
+queues = {}
+
+class Queue(RingbufQueue):
+    def __init__(self, maxsize, policy = DROP_OLDEST, name = None):
+        # The ring keeps one slot empty to tell full from empty
+        super().__init__([None] * (maxsize + 1))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.drops = 0
+        self.high_water = 0
+        if name:
+            queues[name] = self
 
-class Queue(BaseQueue):
-    def __init__(self, maxsize = 0):
-        super().__init__(maxsize)
-        
     def put_nowait(self, val):  # Put an item into the queue without blocking.
         if self.full():
-            self.make_room()
+            if self.policy == BLOCK:
+                raise QueueFull()
+
+            self.drops += 1
+            if self.policy == DROP_NEWEST:
+                return
+
+            try:
+                super().put_nowait(val)
+            except IndexError:
+                # The ring already overwrote the oldest item
+                pass
+            return
+
         super().put_nowait(val)
-            
-    def make_room(self):
+        size = self.qsize()
+        if size > self.high_water:
+            self.high_water = size
+
+    async def get(self):
+        return await self.__anext__()
+
+    def get_nowait(self):
         if self.empty():
             raise QueueEmpty()
-        self.get_nowait()
+        return super().get_nowait()
+
+def stats():
+    return {name: {'size': queue.qsize(), 'max': queue.high_water, 'drops': queue.drops, 'collapsed': getattr(queue, 'collapsed', 0)} for name, queue in queues.items()}
+
+def repeats(queued, item):
+    # Equal in everything but the count kept in the last element
+    last = len(item) - 1
+    if len(queued) != len(item):
+        return False
+    for i in range(last):
+        if queued[i] != item[i]:
+            return False
+    return True
+
+class CriticalQueue():
+    # Two rings: items the predicate marks critical get their own reserved
+    # ring and are always handed out first, so a flood of other items can
+    # only push out other items. An item equal to the newest one still
+    # waiting in its ring is folded into it, counted in its last element.
+    # Only consecutive repeats are folded, so the order is kept
+
+    def __init__(self, maxsize, critical_size, is_critical, name = None):
+        self.critical = Queue(critical_size, DROP_OLDEST)
+        self.normal = Queue(maxsize, DROP_OLDEST)
+        self.is_critical = is_critical
+        self.collapsed = 0
+        self._ready = asyncio.Event()
+        if name:
+            queues[name] = self
+            queues[f'{name}-critical'] = self.critical
+
+    @property
+    def drops(self):
+        return self.normal.drops
+
+    @property
+    def high_water(self):
+        return self.normal.high_water
+
+    def qsize(self):
+        return self.critical.qsize() + self.normal.qsize()
+
+    def empty(self):
+        return self.critical.empty() and self.normal.empty()
+
+    def put_nowait(self, item):
+        queue = self.critical if self.is_critical(item) else self.normal
+        if not queue.empty():
+            newest = queue._q[(queue._wi - 1) % queue._size]
+            if repeats(newest, item):
+                newest[-1] += item[-1]
+                self.collapsed += 1
+                return
+
+        queue.put_nowait(item)
+        self._ready.set()
+
+    def get_nowait(self):
+        if not self.critical.empty():
+            return self.critical.get_nowait()
+        return self.normal.get_nowait()
+
+    async def get(self):
+        while self.empty():
+            self._ready.clear()
+            await self._ready.wait()
+        return self.get_nowait()
@@ -0,0 +1,75 @@
+import os
+
+# Failed gate calls are logged to fail.<n>.log segments. Only the newest
+# SEGMENTS are kept, so rotating drops the oldest segment instead of the
+# whole history
+SEGMENTS = 4
+SEGMENT_SIZE = 8 * 1024
+LEGACY_FILE = 'fail.log'
+
+# segment number -> size, oldest first
+sizes = {}
+current = 0
+current_file = None
+
+def segment_name(n):
+    return f'fail.{n}.log'
+
+def initialize():
+    global current
+
+    for name in os.listdir():
+        if name.startswith('fail.') and name.endswith('.log') and name != LEGACY_FILE:
+            try:
+                n = int(name[5:-4])
+                sizes[n] = os.stat(name)[6]
+            except:
+                pass
+
+    if not sizes:
+        try:
+            os.rename(LEGACY_FILE, segment_name(0))
+            sizes[0] = os.stat(segment_name(0))[6]
+        except OSError:
+            pass
+
+    if sizes:
+        current = max(sizes)
+    print('Fail log segments:', sizes)
+
+def snapshot():
+    # (segment, size) pairs, the current segment can grow after this
+    return [(segment_name(n), sizes[n]) for n in sorted(sizes)]
+
+def rotate():
+    global current
+    global current_file
+
+    if current_file:
+        current_file.close()
+        current_file = None
+
+    current += 1
+    sizes[current] = 0
+    while len(sizes) > SEGMENTS:
+        oldest = min(sizes)
+        del sizes[oldest]
+        try:
+            os.remove(segment_name(oldest))
+        except OSError:
+            pass
+
+def write(lines):
+    global current_file
+
+    record = ''.join([f'{line}\n' for line in lines]) + '\n'
+    record = record.encode('utf8')
+    if sizes.get(current, 0) and sizes[current] + len(record) > SEGMENT_SIZE:
+        rotate()
+
+    # Kept open between records, each record is a single write and flush
+    if current_file is None:
+        current_file = open(segment_name(current), 'ab')
+    current_file.write(record)
+    current_file.flush()
+    sizes[current] = sizes.get(current, 0) + len(record)
@@ -3,14 +3,26 @@ import uasyncio as asyncio
 import json
 import time
 import sim800l
-import os
 import uart
-from dynamic_queue import Queue
+import dynamic_queue
+from dynamic_queue import Queue, DROP_OLDEST
 import phone_numbers
 import led_notif
 import webserver
+import caller_index
+import caller_db
+import state_store
+import fail_log
 
-SLEEP_MS = 50
+HOUSEKEEPING_MS = 1000
+INITIALIZATION_TIMEOUT_MS = 60 * 1000
+INACTIVITY_TIMEOUT_MS = 120 * 1000
+# The watchdog is fed from housekeeping, so it only fires when the event
+# loop stalls, when the modem hasn't reported READY for this long, or when
+# a call or SMS has kept the status polling suspended for MAX_BUSY_MS
+MODEM_SILENCE_MS = 8 * 1000
+MAX_BUSY_MS = INACTIVITY_TIMEOUT_MS
+CREDIT_INFO_FLUSH_MS = 10 * 1000
 
 RST_PIN = 3
 TX_PIN = 4
@@ -31,10 +43,36 @@ reset_pin.high()
 enable_pin = machine.Pin(ENABLE_PIN, machine.Pin.OUT)
 enable_pin.low()
 
+device_queue = None
+debug_queue = None
+command_queue = None
+
+credit_info = ''
+last_credit_info_msg = None
+last_event = 0
+failed_wifi_connects = 0
+wifi_connected = False
+first_time_initialized = False
+last_modem_ready = None
+busy_since = None
+
+# +CLIP line read to enable pin driven
+gate_latency = {
+    'count': 0,
+    'last_us': None,
+    'last_path': None,
+    'min_us': None,
+    'max_us': None,
+    'avg_us': None,
+    'total_us': 0
+}
+
 state = {
     'gate_number': phone_numbers.GATE_NUMBER,
     'owner_number': phone_numbers.OWNER_NUMBER,
     'ep_toggle_duration': 500,
+    'fast_path': False,
+    'caller_db': False,
     'allowed_callers': phone_numbers.ALLOWED_CALLERS.copy(),
     'ssid': None,
     'ssid_password': None
@@ -48,257 +86,406 @@ available_commands = [
     'wifi:connect\nssid\npassword'
 ]
 
-async def sleep(ms = SLEEP_MS):
+async def sleep(ms):
     return await asyncio.sleep_ms(ms)
 
-async def toggle_enable_pin(duration = 500):
-    print('Toggling ENABLE PIN for', duration, 'ms')
-    enable_pin.high()
+def record_gate_latency(received_us, fast_path):
+    latency = time.ticks_diff(time.ticks_us(), received_us)
+    gate_latency['count'] += 1
+    gate_latency['last_us'] = latency
+    gate_latency['last_path'] = 'fast' if fast_path else 'queued'
+    gate_latency['total_us'] += latency
+    gate_latency['avg_us'] = gate_latency['total_us'] // gate_latency['count']
+    if gate_latency['min_us'] is None or latency < gate_latency['min_us']:
+        gate_latency['min_us'] = latency
+    if gate_latency['max_us'] is None or latency > gate_latency['max_us']:
+        gate_latency['max_us'] = latency
+
+async def release_enable_pin(duration):
     await sleep(duration)
     enable_pin.low()
 
-async def main():
-    global state
-    global wifi_status_sms_sent
+def toggle_enable_pin(received_us, fast_path = False):
+    duration = int(state['ep_toggle_duration'])
+    enable_pin.high()
+    record_gate_latency(received_us, fast_path)
+    print('Toggling ENABLE PIN for', duration, 'ms')
+    asyncio.create_task(release_enable_pin(duration))
     
-    led = machine.Pin('LED', machine.Pin.OUT)
-    red_led = machine.Pin(RED_LED_PIN, machine.Pin.OUT)
-    green_led = machine.Pin(GREEN_LED_PIN, machine.Pin.OUT)
+def is_allowed(number):
+    if caller_db.enabled:
+        return caller_db.lookup(number) is not None
+    return caller_index.contains(number)
+
+def fast_path_open_gate(number, received_us):
+    if not is_allowed(number):
+        return False
     
-    led_notif.initialize(red_led, green_led)
+    toggle_enable_pin(received_us, True)
+    return True
 
-    device_queue = Queue(24)
-    debug_queue = Queue(24)
-    command_queue = Queue(8)
+def update_caller_db(toggled = False):
+    # The callers live either in the state, indexed in RAM, or only in the
+    # flash database. Switching moves them from one to the other
+    try:
+        if state.get('caller_db'):
+            callers = state['allowed_callers']
+            caller_db.open_db(callers, toggled)
+            if callers:
+                state['allowed_callers'] = {}
+                save_state(['allowed_callers'])
+            caller_index.build({})
+            return
 
-    uart_config = {
-        'tx': machine.Pin(TX_PIN, machine.Pin.OUT),
-        'rx': machine.Pin(RX_PIN, machine.Pin.IN),
-        'timeout': 250
-    }
+        if toggled and caller_db.enabled:
+            callers = {}
+            for number, name in caller_db.callers():
+                callers[number] = name
+            state['allowed_callers'] = callers
+            # The callers must be on flash in the state before the
+            # database holding them is removed
+            save_state(['allowed_callers', 'caller_db'])
+            state_store.flush()
+            caller_db.clear()
+        caller_index.build(state['allowed_callers'])
+    except Exception as e:
+        print('Caught exception while switching caller database', e)
+        webserver.logs_queue.put_nowait({'event': 'error', 'msg': f'Exception while switching caller database {e}'})
+        state['caller_db'] = caller_db.enabled
+        if not caller_db.enabled:
+            caller_index.build(state['allowed_callers'])
 
-    reader, writer = await uart.initialize(uart_config)
-    asyncio.create_task(sim800l.initialize(device_queue, debug_queue, reader, writer, watchdog))
+def update_fast_path():
+    if state.get('fast_path'):
+        sim800l.set_fast_path(fast_path_open_gate)
+    else:
+        sim800l.set_fast_path(None)
     
-    watchdog.feed()
-    try:
-        with open('state.json', 'r') as state_file:
-            contents = state_file.read()
-            state = json.loads(contents)
-    except Exception as e:
-        print('No last state found')
+def save_state(keys):
+    state_store.changed(keys)
+    
+def state_write_failed(e):
+    print('Caught exception while writing state', e)
+    webserver.logs_queue.put_nowait({'event': 'error', 'msg': f'Exception while writing state failed {e.args[0]}'})
 
-    if state['ssid'] and state['ssid_password']:
-        asyncio.create_task(webserver.initialize(command_queue, state, state['ssid'], state['ssid_password']))
+def caller_db_merge_failed(e):
+    print('Caught exception while merging caller database', e)
+    webserver.logs_queue.put_nowait({'event': 'error', 'msg': f'Exception while merging caller database {e}'})
+
+async def handle_device_event(event):
+    global first_time_initialized
+    global last_modem_ready
+    global credit_info
+    global last_credit_info_msg
+
+    log_event = True
+
+    if event['event'] == 'incoming-event':
+        log_event = False
+        led_notif.start_blink_green(1000)
+        print('device', event)
+    elif event['event'] == 'outgoing-event':
+        log_event = False
+        led_notif.start_blink_green(3000)
+        print('device', event)
+    elif event['event'] == 'initializing':
+        log_event = False
+        led_notif.start_blink_red()
+        print('device', event)
+    elif event['event'] == 'initialized':
+        first_time_initialized = True
+        last_modem_ready = time.ticks_ms()
+        log_event = False
+        await led_notif.stop_blink_red()
+    else:
+        print('device', event)
+
+    if log_event:
+        webserver.logs_queue.put_nowait(event)
         
-    credit_info = ''
-    last_credit_info_msg = None
-    last_event = 0
-    failed_wifi_connects = 0
-    wifi_connected = False
-    first_time_initialized = False
-    loop_start = time.ticks_ms()
+    if event['event'] == 'incoming-call':
+        caller = event['caller']
+        if is_allowed(caller):
+            if not event['gate_opened']:
+                toggle_enable_pin(event['received_us'])
+            asyncio.create_task(sim800l.open_gate(state['gate_number'], caller))
+        else:
+            asyncio.create_task(sim800l.decline_call())
+    
+    if event['event'] == 'incoming-sms':
+        if type(event['data']) is tuple and len(event['data']) == 3:
+            msg_details = event['data'][2] or []
+            msg_from_owner = False
+            msg_from_credit_info = False
+            # Modem work runs in its own task: this consumer also delivers the
+            # incoming-call event a call holding the UART is waiting for
+            asyncio.create_task(sim800l.delete_sms(event['index']))
+            for d in msg_details:
+                if state['owner_number'] in d:
+                    msg_from_owner = True
+                    break
+                if "Credit Info" in d:
+                    msg_from_credit_info = True
+                    break
+                
+            if msg_from_owner:
+                msg = event['data'][2]
+                msg = '\n'.join(msg[1:])
+                original_msg = msg
+                if msg:
+                    msg = msg.lower().strip()
+                if msg == 'help:':
+                    msg = '\n'.join(available_commands)
+                    asyncio.create_task(sim800l.send_sms_with_lock(state['owner_number'], msg))
+                if msg == 'get:credit':
+                    asyncio.create_task(sim800l.check_credit())
+                elif msg == 'delete:sms':
+                    asyncio.create_task(sim800l.delete_sms(aquire_lock=True, delete_all=True))
+                elif msg == 'clear:state':
+                    print('Clearing state and rebooting')
+                    state_store.clear()
+                    caller_db.clear()
+                    print('State removed. Rebooting')
+                    return machine.reset()
+                elif msg == 'wifi:status':
+                    wifi_status, details = webserver.status()
+                    msg = f'Status: {wifi_status}\n Details: {json.dumps(details)}'
+                    asyncio.create_task(sim800l.send_sms_with_lock(state['owner_number'], msg))
+                elif 'wifi:connect' in msg:
+                    segments = original_msg.strip().split('\n')
+                    if len(segments) != 3:
+                        return
+                    
+                    ssid = segments[1]
+                    password = segments[2]
+                    asyncio.create_task(webserver.initialize(command_queue, state, ssid, password))
+                    print(f'Will connect to {ssid}/{password}')
+            elif msg_from_credit_info:
+                msg = event['data'][2]
+                msg = '\n'.join(msg[1:])
+                credit_info = f'{credit_info}{msg}'
+                last_credit_info_msg = time.ticks_ms()
+                
+async def handle_debug_info(info):
+    webserver.logs_queue.put_nowait(info)
+    print('debug', info)
+    
+async def handle_command(cmd):
+    global wifi_status_sms_sent
+    global wifi_connected
+    global failed_wifi_connects
+
+    print('command', cmd)
+    webserver.logs_queue.put_nowait(cmd)
+    state_modified = []
+
+    if cmd['do'] == 'notif-wifi-connecting':
+        led_notif.start_blink_red()
+    
+    if cmd['do'] == 'reset':
+        print('Reseting...')
+        machine.reset()
+    if cmd['do'] == 'enter-debug':
+        sim800l.toggle_debug_mode(True)
+    if cmd['do'] == 'delete-all-sms':
+        print('Deleting all sms')
+        await sim800l.delete_sms(aquire_lock=True, delete_all=True)
+    if cmd['do'] == 'send-at-command':
+        await sim800l.send_at_command(cmd['payload']);
+    if cmd['do'] == 'update-allowed-callers' and not caller_db.enabled:
+        new_dict = {}
+        for name, number in cmd['payload']:
+            new_dict[number] = name
+        old_dict = state['allowed_callers']
+        entries = [number for number in new_dict if old_dict.get(number) != new_dict[number]]
+        entries += [number for number in old_dict if number not in new_dict]
+        state['allowed_callers'] = new_dict
+        caller_index.build(new_dict)
+        state_store.changed_entries('allowed_callers', entries)
+        webserver.state_changed()
+    elif cmd['do'] == 'update-gate-number':
+        state['gate_number'] = cmd['payload']
+        state_modified.append('gate_number')
+    elif cmd['do'] == 'update-ep-toggle-duration':
+        try:
+            state['ep_toggle_duration'] = int(cmd['payload'])
+            state_modified.append('ep_toggle_duration')
+        except:
+            pass
+    elif cmd['do'] == 'update-owner-number':
+        state['owner_number'] = cmd['payload']
+        state_modified.append('owner_number')
+    elif cmd['do'] == 'update-caller-page':
+        for number in cmd['payload']['removed']:
+            caller_db.remove(number)
+        for name, number in cmd['payload']['added']:
+            caller_db.add(name, number)
+        webserver.state_changed()
+    elif cmd['do'] == 'update-caller-db':
+        toggled = bool(cmd['payload']) != bool(state.get('caller_db'))
+        state['caller_db'] = cmd['payload']
+        update_caller_db(toggled)
+        state_modified.append('caller_db')
+    elif cmd['do'] == 'update-fast-path':
+        state['fast_path'] = cmd['payload']
+        update_fast_path()
+        state_modified.append('fast_path')
+    elif cmd['do'] == 'check-credit':
+        asyncio.create_task(sim800l.check_credit())
+    elif cmd['do'] == 'handle-wifi-status':
+        await led_notif.stop_blink_red()
+        result = cmd['payload']
+        if result['status']:
+            state['ssid'] = result['ssid']
+            state['ssid_password'] = result['password']
+            state['ip'] = result['ip']
+            state['port'] = result['port']
+            state_modified = ['ssid', 'ssid_password', 'ip', 'port']
+            
+            ip = state['ip']
+            port = state['port']
+            msg = f'Connected: {ip}:{port}'
+            wifi_connected = True
+        else:
+            failed_wifi_connects += 1
+            try:
+                error_code = webserver.wifi_status_codes[result['code']]
+            except KeyError:
+                error_code = 'unknown-status'
+            msg = f'Unable to connect to wifi: {error_code}'
+            
+        if not wifi_status_sms_sent:
+            if wifi_connected or failed_wifi_connects >= 5:
+                asyncio.create_task(sim800l.send_sms_with_lock(state['owner_number'], msg))
+                wifi_status_sms_sent = True
         
-    watchdog.feed()
+    if state_modified:
+        webserver.state_changed()
+        save_state(state_modified)
+        
+async def dispatch(queue, handler):
+    global last_event
+
+    # Each queue gets its own consumer so an event is handled as soon as it
+    # is put instead of waiting for the next polling tick
+    while True:
+        item = await queue.get()
+        last_event = time.ticks_ms()
+        try:
+            await handler(item)
+        except Exception as e:
+            print('Caught exception while handling', item, e)
+            webserver.logs_queue.put_nowait({'event': 'error', 'msg': f'Exception while handling {item}: {e}'})
+            
+def modem_alive(now):
+    global busy_since
+
+    # Polling is suspended while a call or SMS owns the modem, the lease and
+    # call state timeouts bring it back well within MAX_BUSY_MS
+    if sim800l.is_busy():
+        if busy_since is None:
+            busy_since = now
+        if time.ticks_diff(now, busy_since) < MAX_BUSY_MS:
+            return True
+    else:
+        busy_since = None
+
+    if sim800l.debug_mode:
+        return True
+    return last_modem_ready is not None and time.ticks_diff(now, last_modem_ready) < MODEM_SILENCE_MS
+
+async def housekeeping():
+    global credit_info
+    global last_credit_info_msg
+    global last_event
+
+    led = machine.Pin('LED', machine.Pin.OUT)
+    start = time.ticks_ms()
 
     while True:
         led.toggle()
         now = time.ticks_ms()
         
         if not first_time_initialized:
-            elapsed_initalization = time.ticks_diff(now, loop_start)
+            elapsed_initalization = time.ticks_diff(now, start)
             
-            if elapsed_initalization < (60 * 1000):
+            if elapsed_initalization < INITIALIZATION_TIMEOUT_MS:
                 print("Feeding watch dog while initializing")
                 watchdog.feed()
+        elif modem_alive(now):
+            watchdog.feed()
 
         if last_credit_info_msg:
             last_event = now
             diff = time.ticks_diff(now, last_credit_info_msg)
-            if diff > 10 * 1000:
+            if diff > CREDIT_INFO_FLUSH_MS:
                 asyncio.create_task(sim800l.send_sms_with_lock(state['owner_number'], credit_info))
                 credit_info = ''
                 last_credit_info_msg = None
             
-        while not device_queue.empty():
-            last_event = now
-            event = device_queue.get_nowait()
-            log_event = True
-
-            if event['event'] == 'incoming-event':
-                log_event = False
-                led_notif.start_blink_green(1000)
-                print('device', event)
-            elif event['event'] == 'outgoing-event':
-                log_event = False
-                led_notif.start_blink_green(3000)
-                print('device', event)
-            elif event['event'] == 'initializing':
-                log_event = False
-                led_notif.start_blink_red()
-                print('device', event)
-            elif event['event'] == 'initialized':
-                first_time_initialized = True
-                print("Feeding watch dog")
-                watchdog.feed()
-                log_event = False
-                await led_notif.stop_blink_red()
-            else:
-                print('device', event)
+        webserver.metrics['gate_openings_per_minute'] = sim800l.gate_openings_per_minute()
+        webserver.metrics['queues'] = dynamic_queue.stats()
+        webserver.metrics['uart_stale_releases'] = sim800l.uart_lock.stale_releases
+        webserver.metrics['call_state'] = sim800l.call_state.describe()
 
-            if log_event:
-                webserver.logs_queue.put_nowait(event)
-                
-            if event['event'] == 'incoming-call':
-                caller = event['caller']
-                if caller in state['allowed_callers']:
-                    asyncio.create_task(toggle_enable_pin(int(state['ep_toggle_duration'])))
-                    asyncio.create_task(sim800l.open_gate(state['gate_number'], caller))
-                else:
-                    await sim800l.decline_call()
-            
-            if event['event'] == 'incoming-sms':
-                if type(event['data']) is tuple and len(event['data']) == 3:
-                    msg_details = event['data'][2] or []
-                    msg_from_owner = False
-                    msg_from_credit_info = False
-                    await sim800l.delete_sms(event['index'])
-                    for d in msg_details:
-                        if state['owner_number'] in d:
-                            msg_from_owner = True
-                            break
-                        if "Credit Info" in d:
-                            msg_from_credit_info = True
-                            break
-                        
-                    if msg_from_owner:
-                        msg = event['data'][2]
-                        msg = '\n'.join(msg[1:])
-                        original_msg = msg
-                        if msg:
-                            msg = msg.lower().strip()
-                        if msg == 'help:':
-                            msg = '\n'.join(available_commands)
-                            asyncio.create_task(sim800l.send_sms_with_lock(state['owner_number'], msg))
-                        if msg == 'get:credit':
-                            asyncio.create_task(sim800l.check_credit())
-                        elif msg == 'delete:sms':
-                            await sim800l.delete_sms(aquire_lock=True, delete_all=True)
-                        elif msg == 'clear:state':
-                            print('Clearing state and rebooting')
-                            try:
-                                os.remove('state.json')
-                                print('State removed. Rebooting')
-                                return machine.reset()
-                            except:
-                                print('No state to clear')
-                        elif msg == 'wifi:status':
-                            wifi_status, details = webserver.status()
-                            msg = f'Status: {wifi_status}\n Details: {json.dumps(details)}'
-                            asyncio.create_task(sim800l.send_sms_with_lock(state['owner_number'], msg))
-                        elif 'wifi:connect' in msg:
-                            segments = original_msg.strip().split('\n')
-                            if len(segments) != 3:
-                                continue
-                            
-                            ssid = segments[1]
-                            password = segments[2]
-                            asyncio.create_task(webserver.initialize(command_queue, state, ssid, password))
-                            print(f'Will connect to {ssid}/{password}')
-                    elif msg_from_credit_info:
-                        msg = event['data'][2]
-                        msg = '\n'.join(msg[1:])
-                        credit_info = f'{credit_info}{msg}'
-                        last_credit_info_msg = time.ticks_ms()
-                
-        while not debug_queue.empty():
-            last_event = now
-            info = debug_queue.get_nowait()
-            webserver.logs_queue.put_nowait(info)
-            print('debug', info)
-            
-        state_modified = False
-        while not command_queue.empty():
-            last_event = now
-            cmd = command_queue.get_nowait()
-            print('command', cmd)
-            webserver.logs_queue.put_nowait(cmd)
-            if cmd['do'] == 'notif-wifi-connecting':
-                led_notif.start_blink_red()
-            
-            if cmd['do'] == 'reset':
-                print('Reseting...')
-                machine.reset()
-            if cmd['do'] == 'enter-debug':
-                sim800l.toggle_debug_mode(True)
-            if cmd['do'] == 'delete-all-sms':
-                print('Deleting all sms')
-                await sim800l.delete_sms(aquire_lock=True, delete_all=True)
-            if cmd['do'] == 'send-at-command':
-                await sim800l.send_at_command(cmd['payload']);
-            if cmd['do'] == 'update-allowed-callers':
-                new_dict = {}
-                for name, number in cmd['payload']:
-                    new_dict[number] = name
-                state['allowed_callers'] = new_dict
-                state_modified = True
-            elif cmd['do'] == 'update-gate-number':
-                state['gate_number'] = cmd['payload']
-                state_modified = True
-            elif cmd['do'] == 'update-ep-toggle-duration':
-                try:
-                    state['ep_toggle_duration'] = int(cmd['payload'])
-                    state_modified = True
-                except:
-                    pass
-            elif cmd['do'] == 'update-owner-number':
-                state['owner_number'] = cmd['payload']
-                state_modified = True
-            elif cmd['do'] == 'check-credit':
-                asyncio.create_task(sim800l.check_credit())
-            elif cmd['do'] == 'handle-wifi-status':
-                await led_notif.stop_blink_red()
-                result = cmd['payload']
-                if result['status']:
-                    state['ssid'] = result['ssid']
-                    state['ssid_password'] = result['password']
-                    state['ip'] = result['ip']
-                    state['port'] = result['port']
-                    state_modified = True
-                    
-                    ip = state['ip']
-                    port = state['port']
-                    msg = f'Connected: {ip}:{port}'
-                    wifi_connected = True
-                else:
-                    failed_wifi_connects += 1
-                    try:
-                        error_code = webserver.wifi_status_codes[result['code']]
-                    except KeyError:
-                        error_code = 'unknown-status'
-                    msg = f'Unable to connect to wifi: {error_code}'
-                    
-                if not wifi_status_sms_sent:
-                    if wifi_connected or failed_wifi_connects >= 5:
-                        asyncio.create_task(sim800l.send_sms_with_lock(state['owner_number'], msg))
-                        wifi_status_sms_sent = True
-            else:
-                continue
-                
-        if state_modified:
-            try:
-                with open('state.json', 'w') as state_file:
-                    state_file.write(json.dumps(state))
-            except Exception as e:
-                print('Caught exception while writing state', e)
-                webserver.logs_queue.put_nowait({'event': 'error', 'msg': f'Exception while writing state failed {e.args[0]}'})
-                
-        elapsed_since_last_event = now - last_event
-        if elapsed_since_last_event > (120 * 1000) and not sim800l.debug_mode:
+        elapsed_since_last_event = time.ticks_diff(now, last_event)
+        if elapsed_since_last_event > INACTIVITY_TIMEOUT_MS and not sim800l.debug_mode:
             print("Resetting due to inactivity. This shouldn't happen\n")
             machine.reset()
         
-        await sleep()
+        await sleep(HOUSEKEEPING_MS)
+
+async def main():
+    global state
+    global device_queue
+    global debug_queue
+    global command_queue
+    global last_event
+    
+    red_led = machine.Pin(RED_LED_PIN, machine.Pin.OUT)
+    green_led = machine.Pin(GREEN_LED_PIN, machine.Pin.OUT)
+    
+    led_notif.initialize(red_led, green_led)
+
+    device_queue = Queue(24, DROP_OLDEST, 'device')
+    debug_queue = Queue(24, DROP_OLDEST, 'debug')
+    command_queue = Queue(8, DROP_OLDEST, 'command')
+
+    uart_config = {
+        'tx': machine.Pin(TX_PIN, machine.Pin.OUT),
+        'rx': machine.Pin(RX_PIN, machine.Pin.IN),
+        'timeout': 250
+    }
+
+    reader, writer = await uart.initialize(uart_config)
+    asyncio.create_task(sim800l.initialize(device_queue, debug_queue, reader, writer, watchdog))
+    
+    watchdog.feed()
+    fail_log.initialize()
+    state = state_store.load(state)
+    asyncio.create_task(state_store.run(state_write_failed))
+    asyncio.create_task(caller_db.run(caller_db_merge_failed))
+
+    update_caller_db()
+    update_fast_path()
+    webserver.metrics['gate_latency'] = gate_latency
+    webserver.metrics['calls'] = sim800l.call_stats
+    webserver.metrics['caller_index'] = caller_index.stats
+    webserver.metrics['state_writes'] = state_store.stats
+    webserver.metrics['events'] = webserver.events_stats
+    webserver.metrics['uart_lock'] = sim800l.uart_lock.stats
+
+    if state['ssid'] and state['ssid_password']:
+        asyncio.create_task(webserver.initialize(command_queue, state, state['ssid'], state['ssid_password']))
+        
+    last_event = time.ticks_ms()
+    watchdog.feed()
+
+    asyncio.create_task(dispatch(device_queue, handle_device_event))
+    asyncio.create_task(dispatch(debug_queue, handle_debug_info))
+    asyncio.create_task(dispatch(command_queue, handle_command))
+    
+    await housekeeping()
     
 asyncio.run(main())
 asyncio.new_event_loop()
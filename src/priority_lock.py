@@ -0,0 +1,138 @@
+import uasyncio as asyncio
+import time
+
+# Lower goes first
+CALL = 0
+POWER = 1
+COMMAND = 2
+SMS = 3
+
+DEFAULT_MAX_HOLD_MS = 10 * 1000
+LEASE_CHECK_MS = 250
+
+class PriorityLock():
+    # Like asyncio.Lock, but when it is released it goes to the waiter with
+    # the highest priority, in arrival order within the same priority.
+    #
+    # Every acquire is a lease: it has an owner name, returns a lease number
+    # and can only be released with that number. A lease held longer than
+    # its max hold time is taken back by supervise(), a release arriving
+    # after that is ignored instead of freeing somebody else's lease
+
+    def __init__(self):
+        self._locked = False
+        # [priority, arrival, event, owner, max hold, asked at, lease granted]
+        self._waiters = []
+        self._arrivals = 0
+        self.lease = 0
+        self.owner = None
+        self._acquired = 0
+        self._max_hold = 0
+        # owner -> counters
+        self.stats = {}
+        self.stale_releases = 0
+
+    def locked(self):
+        return self._locked
+
+    def _owner_stats(self, owner):
+        stats = self.stats.get(owner)
+        if stats is None:
+            stats = {'leases': 0, 'wait_ms': 0, 'max_wait_ms': 0, 'hold_ms': 0, 'max_hold_ms': 0, 'expired': 0}
+            self.stats[owner] = stats
+        return stats
+
+    def _grant(self, owner, max_hold, asked):
+        now = time.ticks_ms()
+        self._locked = True
+        self.lease += 1
+        self.owner = owner
+        self._acquired = now
+        self._max_hold = max_hold
+
+        stats = self._owner_stats(owner)
+        waited = time.ticks_diff(now, asked)
+        stats['leases'] += 1
+        stats['wait_ms'] += waited
+        stats['max_wait_ms'] = max(stats['max_wait_ms'], waited)
+        return self.lease
+
+    async def acquire(self, owner, priority = COMMAND, max_hold_ms = DEFAULT_MAX_HOLD_MS):
+        asked = time.ticks_ms()
+        if not self._locked and not self._waiters:
+            return self._grant(owner, max_hold_ms, asked)
+
+        self._arrivals += 1
+        waiter = [priority, self._arrivals, asyncio.Event(), owner, max_hold_ms, asked, None]
+        self._waiters.append(waiter)
+        try:
+            await waiter[2].wait()
+        except BaseException:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter[6] is not None:
+                # Handed over right as it was cancelled, pass it on
+                self.release(waiter[6])
+            raise
+        return waiter[6]
+
+    def release(self, lease):
+        if not self._locked or lease != self.lease:
+            self.stale_releases += 1
+            return False
+
+        held = time.ticks_diff(time.ticks_ms(), self._acquired)
+        stats = self._owner_stats(self.owner)
+        stats['hold_ms'] += held
+        stats['max_hold_ms'] = max(stats['max_hold_ms'], held)
+        self._hand_over()
+        return True
+
+    def _hand_over(self):
+        if not self._waiters:
+            self._locked = False
+            self.owner = None
+            return
+
+        # Stays locked, ownership goes straight to the next waiter
+        waiter = min(self._waiters)
+        self._waiters.remove(waiter)
+        waiter[6] = self._grant(waiter[3], waiter[4], waiter[5])
+        waiter[2].set()
+
+    async def supervise(self, on_expire):
+        while True:
+            await asyncio.sleep_ms(LEASE_CHECK_MS)
+            if not self._locked:
+                continue
+
+            held = time.ticks_diff(time.ticks_ms(), self._acquired)
+            if held <= self._max_hold:
+                continue
+
+            owner = self.owner
+            stats = self._owner_stats(owner)
+            stats['expired'] += 1
+            stats['hold_ms'] += held
+            stats['max_hold_ms'] = max(stats['max_hold_ms'], held)
+            self._hand_over()
+            on_expire(owner, held)
+
+    def holding(self, owner, priority = COMMAND, max_hold_ms = DEFAULT_MAX_HOLD_MS):
+        return Holding(self, owner, priority, max_hold_ms)
+
+class Holding():
+
+    def __init__(self, lock, owner, priority, max_hold_ms):
+        self._lock = lock
+        self._owner = owner
+        self._priority = priority
+        self._max_hold_ms = max_hold_ms
+        self._lease = None
+
+    async def __aenter__(self):
+        self._lease = await self._lock.acquire(self._owner, self._priority, self._max_hold_ms)
+        return self._lease
+
+    async def __aexit__(self, *args):
+        self._lock.release(self._lease)
@@ -1,12 +1,44 @@
 import uasyncio as asyncio
-from machine import WDT
 import time
-import os
-from dynamic_queue import Queue
+from dynamic_queue import Queue, CriticalQueue, BLOCK
+from uart import LineReader, Frame, decode
+import fail_log
+from priority_lock import PriorityLock, CALL, COMMAND, SMS
+from call_state import CallStateMachine, IDLE, INCOMING, DIALING, RINGING, GATE_OK, HANGING_UP
 
 SLEEP_MS = 50
 MAX_LOCK_DURATION_S = 30
 
+STATUS_POLL_MS = 1000
+NETWORK_POLL_MS = 10 * 1000
+SIGNAL_POLL_MIN_MS = 2000
+SIGNAL_POLL_MAX_MS = 60 * 1000
+SIGNAL_CHANGE_THRESHOLD = 2
+
+# How long the gate is left ringing before hanging up
+GATE_RING_MS = 500
+GATE_FIRST_RING_MS = 30 * 1000
+HANG_UP_TIMEOUT_MS = 5000
+PIN_READY_TIMEOUT_S = 5
+
+# Incoming calls are admitted into a queue and served one at a time. The
+# modem repeats +CLIP on every RING, repeats are folded into the queued call
+MAX_QUEUED_CALLS = 8
+CALL_ADMISSION_TIMEOUT_MS = 15 * 1000
+CALL_HANDLING_TIMEOUT_S = 10
+# Longest a task may keep the UART before its lease is taken back
+CALL_HOLD_MS = (CALL_HANDLING_TIMEOUT_S + 5) * 1000
+SMS_HOLD_MS = 45 * 1000
+CLIP_DEDUP_MS = 3000
+THROUGHPUT_WINDOW_MS = 60 * 1000
+
+call_state = CallStateMachine({
+    INCOMING: CALL_HANDLING_TIMEOUT_S * 1000,
+    DIALING: GATE_FIRST_RING_MS,
+    RINGING: GATE_RING_MS,
+    HANGING_UP: HANG_UP_TIMEOUT_MS
+})
+
 watchdog = None
 device_queue = None
 debug_queue = None
@@ -14,25 +46,49 @@ debug_mode = False
 reader = None
 writer = None
 
-write_queue = Queue(24)
-read_queue = Queue(24)
-urc_queue = Queue(24)
+# send() waits for room instead of losing commands
+write_queue = Queue(24, BLOCK, 'write')
+# Calls, new SMS and power downs have their own ring in the URC queue, a
+# flood of ring/carrier/voltage warning lines can't push them out
+CRITICAL_URCS = ('+CLIP', '+CMTI', 'NORMAL POWER DOWN', 'UNDER-VOLTAGE POWER DOWN', 'OVER-VOLTAGE POWER DOWN')
+URC_QUEUE_SIZE = 24
+CRITICAL_URC_QUEUE_SIZE = 16
+
+def is_critical_urc(item):
+    return item[0] in CRITICAL_URCS
+
+# Items are [code, data, handler, repeat count]
+urc_queue = CriticalQueue(URC_QUEUE_SIZE, CRITICAL_URC_QUEUE_SIZE, is_critical_urc, 'urc')
 
 pin_set = False
 pin_timeout_count = 0
 pin_query_fail_count = 0
-caller = None
-incoming_call_in_progress = False
 
-callee = None
-outgoing_call_in_progress = False
-outgoing_operation_in_progress = False
-
-first_ring_event = asyncio.Event()
-first_ring_event.set()
+call_queue = []
+call_queued_event = asyncio.Event()
+current_call = None
+# number -> ticks when its last call ended
+ended_calls = {}
+gate_openings = []
+# number -> ticks_us when the +CLIP line was read
+clip_received = {}
+
+# Opt-in callback the reader calls with (number, received_us) as soon as a
+# +CLIP is parsed. It returns True if it opened the gate
+fast_path = None
+# number -> ticks when the fast path opened the gate for it
+fast_path_opened = {}
+call_stats = {
+    'queued': 0,
+    'served': 0,
+    'duplicates': 0,
+    'expired': 0,
+    'rejected': 0,
+    'last_latency_ms': None,
+    'max_latency_ms': 0
+}
 
-gate_ring_ok = False
-gate_last_urc = None
+pin_ready_event = asyncio.Event()
 
 last_state = {
     'network': None,
@@ -43,70 +99,135 @@ last_state = {
     'product_details': None
 }
 
-URC = [
-    '+CLIP',
-    '+CPIN',
-    'SMS Ready',
-    'Call Ready',
-    '+CMTI',
-    '+CDRIND',
-    'RING',
-    'MO RING',
-    'MO CONNECTED',
-    'BUSY',
-    'NO CARRIER',
-    'NO DIALTONE',
-    'NO ANSWER',
-    'NORMAL POWER DOWN',
-    'UNDER-VOLTAGE POWER DOWN',
-    'UNDER-VOLTAGE WARNING',
-    'OVER-VOLTAGE POWER DOWN',
-    'OVER-VOLTAGE WARNING',
-    'CHARGE-ONLY MODE',
-    'RDY'
-]
-
-ignore_urc_list = [
-    'RING',
-    '+CPIN',
-    'SMS Ready',
-    'Call Ready',
-    'CHARGE-ONLY MODE',
-    'RDY'
-]
-
-line_buffer = []
-
-uart_lock = asyncio.Lock()
-command_lock = asyncio.Lock()
-write_lock = asyncio.Lock()
+# Product and firmware don't change while the modem is up, they are read
+# once after it reports READY and again only after it restarts (RDY)
+identity_known = False
+next_poll = {
+    '+COPS?': 0,
+    '+CSQ': 0
+}
+signal_poll_ms = SIGNAL_POLL_MIN_MS
+last_signal_level = None
+
+# Some URC codes are also the answer to a command we issued. urc_table lists
+# that command (without the AT prefix) so the line is treated as a response
+# when it is part of the command in flight
+HANG_UP = 'H'
+PIN_QUERY = '+CPIN?'
+
+FINAL_RESULT_CODES = (b'OK', b'ERROR', b'+CME ERROR', b'+CMS ERROR')
+# AT+CMGS answers with '> ' and no line end, the message is written after it
+SMS_PROMPT = b'> '
+PROMPT_TERMINATORS = (b'>', b'ERROR', b'+CME ERROR', b'+CMS ERROR')
+ESC = chr(27)
+
+# Longest URC code is 'UNDER-VOLTAGE POWER DOWN'
+MAX_CODE_LENGTH = 24
+
+line_reader = None
+# Response frames are double buffered: one is being filled by the reader
+# while the other is handed to the command it answers
+frames = None
+response_frame = None
+
+# Waiters get the UART in priority order: calls, power, commands, SMS
+uart_lock = PriorityLock()
 last_command = None
+last_command_parts = ()
+in_flight = None
+
+class Command():
+
+    def __init__(self, text, timeout, terminators = FINAL_RESULT_CODES, no_wait = False, prompt = None):
+        self.text = text
+        self.timeout = timeout
+        self.terminators = terminators
+        self.no_wait = no_wait
+        self.prompt = prompt
+        # The modem echoes the command line before answering it, a frame is
+        # only handed to the command whose echo opened it. The SMS body and
+        # ESC have no single echo line to wait for
+        self.echo = text.encode() if text.startswith('AT') and '\n' not in text else None
+        self.status = None
+        self.frame = None
+        self.done = asyncio.Event()
+        
+    def resolve(self, status, frame = None):
+        if self.done.is_set():
+            return
+        self.status = status
+        self.frame = frame
+        self.done.set()
+        
+def command_parts(text):
+    # 'AT+CPIN?;+COPS?' -> ['+CPIN?', '+COPS?']
+    if not text.startswith('AT'):
+        return ()
+    return text[2:].split(';')
+
+class IncomingCall():
+
+    def __init__(self, number, code, received_us, gate_opened):
+        self.number = number
+        self.code = code
+        self.received = time.ticks_ms()
+        self.received_us = received_us
+        self.gate_opened = gate_opened
+        self.clips = 1
+        self.lease = None
+        self.done = asyncio.Event()
 
 def is_busy():
-    # print(incoming_call_in_progress, outgoing_call_in_progress, outgoing_operation_in_progress)
-    return incoming_call_in_progress or outgoing_call_in_progress or outgoing_operation_in_progress
+    return not call_state.idle() or len(call_queue) > 0
     
 async def sleep(ms = SLEEP_MS):
     return await asyncio.sleep_ms(ms)
 
-def is_unsolicited(msg):
-    segments = msg.split(':')
-    code = segments.pop(0)
-    
-    if code in ('+CDRIND', 'BUSY', 'NO CARRIER', 'NO ANSWER', 'NO DIALTONE'):
-        if last_command == 'ATH':
-            return False
+def line_code(line):
+    # The code is the part before ':' or the whole line. Anything longer than
+    # a code is payload (SMS text, product info) and doesn't need a lookup.
+    # Only the head that can hold a code is copied, the search runs in C
+    head = bytes(line[:MAX_CODE_LENGTH + 1])
+    i = head.find(b':')
+    if i != -1:
+        return head[:i]
         
-    if code == '+CPIN' and last_command == 'AT+CPIN?':
-        return False
+    if len(head) <= MAX_CODE_LENGTH:
+        return head
     
-    return code in URC
+    return None
+
+def is_echo(line, echo):
+    length = len(echo)
+    if len(line) != length:
+        return False
+    for i in range(length):
+        if line[i] != echo[i]:
+            return False
+    return True
+
+def classify_urc(code):
+    entry = urc_table.get(code)
+    if entry is None:
+        return None
+
+    handler, ignored, answers_command = entry
+    if answers_command is not None and answers_command in last_command_parts:
+        return None
+
+    return handler, ignored
 
 async def send_sms(number, message):
     print('sending sms to', number, message)
     await send('AT+CMGF=1')
     watchdog.feed()
-    await send(f'AT+CMGS="{number}"', no_wait=True)
+    _, status, _ = await send(f'AT+CMGS="{number}"', timeout=5, terminators=PROMPT_TERMINATORS, prompt=SMS_PROMPT)
+    if status != '>':
+        # Takes the modem out of text entry in case the prompt was missed
+        await send(ESC, no_wait=True)
+        debug_queue.put_nowait({'event': 'error', 'msg': 'No SMS prompt', 'status': status})
+        return
+    
     sms = message + '\r\n' + chr(26)
     watchdog.feed()
     await send(sms, timeout=30)
@@ -114,7 +235,7 @@ async def send_sms(number, message):
     
 async def send_sms_with_lock(number, message):
     device_queue.put_nowait({'event': 'outgoing-event'})
-    async with uart_lock:
+    async with uart_lock.holding('send-sms', SMS, SMS_HOLD_MS):
         await send_sms(number, message)
     
 async def delete_sms(index = 1, aquire_lock = True, delete_all = False):
@@ -124,7 +245,7 @@ async def delete_sms(index = 1, aquire_lock = True, delete_all = False):
         del_flag = 0
         
     if aquire_lock:
-        async with uart_lock:
+        async with uart_lock.holding('delete-sms', SMS):
             await send(f'AT+CMGD={index},{del_flag}')
             return
         
@@ -132,213 +253,293 @@ async def delete_sms(index = 1, aquire_lock = True, delete_all = False):
     
 async def relay_sms(number, message, msg_index):
     print('relaying sms to', number, message, msg_index)
-    global outgoing_operation_in_progress
-    async with uart_lock:
-        watchdog.feed()
-        outgoing_operation_in_progress = True
-        await delete_sms(msg_index, aquire_lock=False)
-        watchdog.feed()
-        await send_sms(number, message)
+    async with uart_lock.holding('relay-sms', SMS, SMS_HOLD_MS):
         watchdog.feed()
-        outgoing_operation_in_progress = False
+        call_state.begin_operation()
+        try:
+            await delete_sms(msg_index, aquire_lock=False)
+            watchdog.feed()
+            await send_sms(number, message)
+            watchdog.feed()
+        finally:
+            call_state.end_operation()
         
 async def check_credit():
-    global outgoing_operation_in_progress
     await sleep(1000)
-    async with uart_lock:
-        outgoing_operation_in_progress = True
-        print('calling credit info number')
-        await send('ATD333;')
-        outgoing_operation_in_progress = False
+    async with uart_lock.holding('check-credit', COMMAND, SMS_HOLD_MS):
+        call_state.begin_operation()
+        try:
+            print('calling credit info number')
+            await send('ATD333;')
+        finally:
+            call_state.end_operation()
         
     
 async def call_gate(number, caller):
-    global outgoing_call_in_progress
-    global callee
-    global gate_ring_ok
-
-    first_ring_event.clear()
-
-    outgoing_call_in_progress = True
-    callee = number
-
     max_retries = 3
     retry_counter = 0
     
     failed_message = None
     log_messages = [f'Starting gate {number} call procedure for {caller}']
 
-    try:
+    while True:
+        if retry_counter >= max_retries:
+            log_messages.append(f'{time.ticks_ms()} Reached retry limit. Calling failed')
+            break
+
+        if not call_state.dial(number):
+            failed_message = f'Unable to call gate while {call_state.state}'
+            log_messages.append(f'{time.ticks_ms()} {failed_message}')
+            break
+
+        device_queue.put_nowait({'event': 'outgoing-event'})
+        log_messages.append(f'{time.ticks_ms()} Calling gate')
+        call_cmd_status, call_status, call_result = await send(f'ATD{number};')
         
-        while True:
-            if retry_counter >= max_retries:
-                log_messages.append(f'{time.ticks_ms()} Reached retry limit. Calling failed')
-                break
+        if call_status != 'OK':
+            call_state.handle('end')
+            retry_counter += 1
+            failed_message = f'Unable to call gate. Reason {call_cmd_status}, {call_status}, {str(call_result)}'
+            log_messages.append(f'{time.ticks_ms()} Calling failed: {failed_message}')
+            await sleep()
+            continue
 
-            device_queue.put_nowait({'event': 'outgoing-event'})
-            log_messages.append(f'{time.ticks_ms()} Calling gate')
-            call_cmd_status, call_status, call_result = await send(f'ATD{number};')
-            
-            if call_status != 'OK':
-                retry_counter += 1
-                first_ring_event.set()
-                failed_message = f'Unable to call gate. Reason {call_cmd_status}, {call_status}, {str(call_result)}'
-                log_messages.append(f'{time.ticks_ms()} Calling failed: {failed_message}')
-                await sleep()
-                continue
-
-            log_messages.append(f'{time.ticks_ms()} Waiting for first ring')
-            await asyncio.wait_for(first_ring_event.wait(), 30)
-            await sleep(500)
-
-            log_messages.append(f'{time.ticks_ms()} Last URC: {gate_last_urc}')
-            
-            if gate_ring_ok:
-                log_messages.append(f'{time.ticks_ms()} Gate response is OK. Canceling ringing')
-                print("Gate response is OK")
-                _, _, result = await send('ATH', timeout=2, expect_single_line_response=False)
-                await handle_call_ending(result)
-                gate_ring_ok = False
-                failed_message = None
-                break
-            
-            log_messages.append(f'{time.ticks_ms()} Gate response is invalid. Retrying')
+        # Ringing for GATE_RING_MS moves the call to GATE_OK on its own, no
+        # ring or a rejection brings it back to IDLE
+        log_messages.append(f'{time.ticks_ms()} Waiting for first ring')
+        state = await call_state.wait_for((GATE_OK, IDLE))
+        log_messages.append(f'{time.ticks_ms()} Last URC: {call_state.detail}')
+        
+        if state == GATE_OK:
+            log_messages.append(f'{time.ticks_ms()} Gate response is OK. Canceling ringing')
+            print("Gate response is OK")
+            call_state.handle('hangup')
+            _, _, result = await send('ATH', timeout=2, expect_single_line_response=False)
+            await handle_call_ending(result)
+            failed_message = None
+            break
+        
+        if call_state.event == 'timeout':
+            log_messages.append(f'{time.ticks_ms()} Timeout occured while waiting to first ring')
+            print('Timeout occured while waiting to first ring')
+            failed_message = 'Timeout occured while waiting for first ring'
+            debug_queue.put_nowait({'event': 'error', 'msg': 'Timeout occured while waiting for first ring'})
+            break
+        
+        log_messages.append(f'{time.ticks_ms()} Gate response is invalid. Retrying')
 
-            retry_counter += 1
-            print("Gate response is invalid. Retrying...")
-    except asyncio.TimeoutError:
-        first_ring_event.set()
-        log_messages.append(f'{time.ticks_ms()} Timeout occured while waiting to first ring');
-        print('Timeout occured while waiting to first ring')
-        failed_message = 'Timeout occured while waiting for first ring'
-        debug_queue.put_nowait({'event': 'error', 'msg': 'Timeout occured while waiting for first ring'})
-    finally:
-        outgoing_call_in_progress = False
+        retry_counter += 1
+        print("Gate response is invalid. Retrying...")
 
     if failed_message:
         try:
-            fail_log_stats = os.stat('fail.log')
-            print(f"Fail log size is: {fail_log_stats[6]}")
-            if int(fail_log_stats[6]) > (32 * 1000):
-                print("Deleting fail log")
-                os.remove('fail.log')
-        except:
-            pass
-
-        try:
-            with open('fail.log', 'a') as fail_log:
-                for msg in log_messages:
-                    fail_log.write(f"{msg}\n")
-                fail_log.write("\n")
+            fail_log.write(log_messages)
         except Exception as e:
             print(f"Failed to write log file: {str(e)}")
         await send_sms(caller, failed_message)
 
 async def open_gate(gate_number, caller):
-    global outgoing_operation_in_progress
-
-    outgoing_operation_in_progress = True
-
+    call_state.handle('hangup')
     try:
         _, _, result = await send('ATH', timeout=5, expect_single_line_response=False)
         await handle_call_ending(result)
-        await sleep(500)
     except Exception as e:
         print(e)
     finally:
-        await sleep(1000)
-        outgoing_operation_in_progress = False
-        uart_lock.release() if uart_lock.locked() else None
+        release_call_lease()
+        finish_call(True)
         
 async def decline_call():
+    call_state.handle('hangup')
     try:
         _, _, result = await send('ATH', timeout=5, expect_single_line_response=False)
         await handle_call_ending(result)
     except Exception as e:
         print(e)
     finally:
-        await sleep(1000)
-        uart_lock.release() if uart_lock.locked() else None
+        release_call_lease()
+        finish_call(False)
+        
+def find_call(number):
+    if current_call and current_call.number == number:
+        return current_call
+    
+    for call in call_queue:
+        if call.number == number:
+            return call
+    return None
+
+def finish_call(gate_opened):
+    if current_call is None:
+        return
+    
+    now = time.ticks_ms()
+    latency = time.ticks_diff(now, current_call.received)
+    call_stats['served'] += 1
+    call_stats['last_latency_ms'] = latency
+    call_stats['max_latency_ms'] = max(call_stats['max_latency_ms'], latency)
+
+    if gate_opened:
+        gate_openings.append(now)
+        while gate_openings and time.ticks_diff(now, gate_openings[0]) > THROUGHPUT_WINDOW_MS:
+            gate_openings.pop(0)
+        
+    current_call.done.set()
+    
+def gate_openings_per_minute():
+    now = time.ticks_ms()
+    return len([t for t in gate_openings if time.ticks_diff(now, t) <= THROUGHPUT_WINDOW_MS])
+
+def clip_number(data):
+    return data.split(',').pop(0).strip().replace('"', '')
+
+def set_fast_path(callback):
+    global fast_path
+    fast_path = callback
     
+def recently_ended(number, now):
+    ended = ended_calls.get(number)
+    return ended is not None and time.ticks_diff(now, ended) < CLIP_DEDUP_MS
+
+def try_fast_path(number, received_us):
+    if fast_path is None or find_call(number):
+        return
+    
+    now = time.ticks_ms()
+    if recently_ended(number, now):
+        return
+    
+    opened = fast_path_opened.get(number)
+    if opened is not None and time.ticks_diff(now, opened) < CALL_ADMISSION_TIMEOUT_MS:
+        return
+    
+    if fast_path(number, received_us):
+        fast_path_opened[number] = now
 
 async def handle_incoming_call(code, data):
-    global incoming_call_in_progress
-    global caller
+    number = clip_number(data)
+    now = time.ticks_ms()
+    received_us = clip_received.pop(number, None)
+    gate_opened = fast_path_opened.pop(number, None) is not None
+    
+    call = find_call(number)
+    if call:
+        call.clips += 1
+        call_stats['duplicates'] += 1
+        return
+    
+    # +CLIP lines still queued when a call was hung up
+    if recently_ended(number, now):
+        call_stats['duplicates'] += 1
+        return
     
-    if incoming_call_in_progress:
+    if len(call_queue) >= MAX_QUEUED_CALLS:
+        call_stats['rejected'] += 1
+        debug_queue.put_nowait({'event': 'error', 'msg': 'Call queue full', 'caller': number})
         return
 
     device_queue.put_nowait({'event':'incoming-event'})
+    if received_us is None:
+        received_us = time.ticks_us()
+    call_queue.append(IncomingCall(number, code, received_us, gate_opened))
+    call_stats['queued'] += 1
+    call_queued_event.set()
     
-    incoming_call_in_progress = True
-    number = data.split(',').pop(0).strip().replace('"', '')
-    caller = number
-    await uart_lock.acquire()
-    device_queue.put_nowait({'event':'incoming-call', 'code': code, 'caller': number})
-    await sleep()
+def release_call_lease():
+    # Only the lease taken for the call being served, never whoever holds
+    # the UART now
+    if current_call:
+        uart_lock.release(current_call.lease)
 
-async def handle_incoming_sms(_, data):
-    global incoming_call_in_progress
+def lease_expired(owner, held):
+    print('UART lease expired', owner, held)
+    debug_queue.put_nowait({'event': 'error', 'msg': 'UART lease expired', 'owner': owner, 'held_ms': held})
 
+async def serve_calls():
+    global current_call
+    
+    while True:
+        while not len(call_queue):
+            call_queued_event.clear()
+            await call_queued_event.wait()
+            
+        call = call_queue.pop(0)
+        if time.ticks_diff(time.ticks_ms(), call.received) > CALL_ADMISSION_TIMEOUT_MS:
+            call_stats['expired'] += 1
+            continue
+        
+        call.lease = await uart_lock.acquire('call', CALL, CALL_HOLD_MS)
+        call_state.incoming(call.number)
+        current_call = call
+        device_queue.put_nowait({'event':'incoming-call', 'code': call.code, 'caller': call.number, 'received_us': call.received_us, 'gate_opened': call.gate_opened})
+        
+        try:
+            await asyncio.wait_for(call.done.wait(), CALL_HANDLING_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            # The incoming-call event was never handled
+            debug_queue.put_nowait({'event': 'error', 'msg': 'Incoming call not handled', 'caller': call.number})
+            call_state.handle('abandon')
+            uart_lock.release(call.lease)
+            
+        ended_calls[call.number] = time.ticks_ms()
+        for number in list(ended_calls):
+            if time.ticks_diff(time.ticks_ms(), ended_calls[number]) > CLIP_DEDUP_MS:
+                del ended_calls[number]
+        current_call = None
+
+async def handle_incoming_sms(_, data):
     device_queue.put_nowait({'event':'incoming-event'})
 
     msg_index = data.split(',').pop()
-    async with uart_lock:
-        incoming_call_in_progress = True
-        await send('AT+CMGF=1')
-        cmd_status, status, result = await send(f'AT+CMGR={msg_index}', expect_single_line_response=False)
+    call_state.begin_operation()
+    try:
+        # The lock is taken per command, a call waiting for the UART gets
+        # it in between
+        async with uart_lock.holding('read-sms', SMS):
+            await send('AT+CMGF=1')
+        async with uart_lock.holding('read-sms', SMS):
+            cmd_status, status, result = await send(f'AT+CMGR={msg_index}', expect_single_line_response=False)
         device_queue.put_nowait({'event':'incoming-sms', 'index': msg_index, 'data': (cmd_status, status, result)})
-        incoming_call_in_progress = False
+    finally:
+        call_state.end_operation()
 
         
-async def handle_call_ending(code):
-    global caller
-    global incoming_call_in_progress
-
-    global callee
-    global outgoing_call_in_progress
+async def handle_call_ending(code, _data = None):
+    # Late +CDRIND or a second hang up result for a call already over
+    if call_state.state == IDLE:
+        print('Call ending without a call', code)
+        return
     
-    if incoming_call_in_progress:
-        incoming_call_in_progress = False
-        event = 'incoming-call-end'
-        number = caller
-        caller = None
-    elif outgoing_call_in_progress:
-        outgoing_call_in_progress = False
-        event = 'outgoing-call-end'
-        number = callee
-        callee = None
-        
-    try:
-        device_queue.put_nowait({'event': event, 'code': code, 'number': number})
-    except:
-        print(code)
-    finally:
-        await sleep()
+    event = f'{call_state.direction}-call-end'
+    number = call_state.number
+    call_state.handle('end', code)
+    device_queue.put_nowait({'event': event, 'code': code, 'number': number})
 
-async def handle_call_in_progress(code):
-    global gate_ring_ok
-    global gate_last_urc
-    first_ring_event.set()
-    
-    gate_last_urc = code
-    
+async def handle_call_in_progress(code, _data = None):
     if code == 'MO RING' or code == 'MO CONNECTED':
-        gate_ring_ok = True
+        call_state.handle('ring', code)
+    else:
+        call_state.handle('rejected', code)
 
-    device_queue.put_nowait({'event': 'outgoing-ringing', 'code': code, 'number': caller})
-    await sleep()
+    device_queue.put_nowait({'event': 'outgoing-ringing', 'code': code, 'number': call_state.number})
 
-async def handle_voltage_related_signals(code):
+async def handle_modem_ready(code, data):
+    global identity_known
+    
+    if code == 'RDY':
+        identity_known = False
+        pin_ready_event.clear()
+    elif data and data.strip() == 'READY':
+        identity_known = False
+        pin_ready_event.set()
+
+async def handle_voltage_related_signals(code, _data = None):
     if code == 'NORMAL POWER DOWN' or code == 'OVER-VOLTAGE POWER DOWN':
         device_queue.put_nowait({'event': 'exception', 'msg': 'Device shutdown', 'code': code})
-        return await sleep()
+        return
         
     if 'WARNING' in code:
         debug_queue.put_nowait({'event': 'warning', 'msg': 'Voltage warning', 'code': code})
-        return await sleep()
-
-    await sleep()
     
 def process_command_result(command, command_result, expect_single_line_response):
     if command_result is not None and len(command_result) and command == command_result[0]:
@@ -359,81 +560,115 @@ def process_command_result(command, command_result, expect_single_line_response)
     return status, command_result
     
 
-def is_ignored_urc(msg):
-    segments = msg.split(':')
-    code = segments.pop(0)
+# code: (handler, ignored, command the code is an answer to)
+urc_table = {
+    b'+CLIP': (handle_incoming_call, False, None),
+    b'+CPIN': (handle_modem_ready, False, PIN_QUERY),
+    b'SMS Ready': (None, True, None),
+    b'Call Ready': (None, True, None),
+    b'+CMTI': (handle_incoming_sms, False, None),
+    b'+CDRIND': (handle_call_ending, False, HANG_UP),
+    b'RING': (None, True, None),
+    b'MO RING': (handle_call_in_progress, False, None),
+    b'MO CONNECTED': (handle_call_in_progress, False, None),
+    b'BUSY': (handle_call_in_progress, False, HANG_UP),
+    b'NO CARRIER': (handle_call_in_progress, False, HANG_UP),
+    b'NO DIALTONE': (handle_call_in_progress, False, HANG_UP),
+    b'NO ANSWER': (handle_call_in_progress, False, HANG_UP),
+    b'NORMAL POWER DOWN': (handle_voltage_related_signals, False, None),
+    b'UNDER-VOLTAGE POWER DOWN': (handle_voltage_related_signals, False, None),
+    b'UNDER-VOLTAGE WARNING': (handle_voltage_related_signals, False, None),
+    b'OVER-VOLTAGE POWER DOWN': (handle_voltage_related_signals, False, None),
+    b'OVER-VOLTAGE WARNING': (handle_voltage_related_signals, False, None),
+    b'CHARGE-ONLY MODE': (None, True, None),
+    b'RDY': (handle_modem_ready, False, None)
+}
 
-    return code in ignore_urc_list
+# Each group of URC handlers runs in its own worker, so a call is never
+# handled behind an SMS being read. The workers keep the reserved ring for
+# critical URCs too, a burst of MO RING/NO CARRIER lines can't push a +CLIP
+# out on its way to the handler
+call_urcs = CriticalQueue(8, CRITICAL_URC_QUEUE_SIZE, is_critical_urc, 'urc-call')
+power_urcs = CriticalQueue(8, CRITICAL_URC_QUEUE_SIZE, is_critical_urc, 'urc-power')
+sms_urcs = CriticalQueue(16, CRITICAL_URC_QUEUE_SIZE, is_critical_urc, 'urc-sms')
+urc_workers = {
+    handle_incoming_call: call_urcs,
+    handle_call_ending: call_urcs,
+    handle_call_in_progress: call_urcs,
+    handle_modem_ready: power_urcs,
+    handle_voltage_related_signals: power_urcs,
+    handle_incoming_sms: sms_urcs
+}
+
+async def process_unsolicited(code, data, handler):
+    if handler:
+        return await handler(code, data)
     
+def find_result(lines, prefix):
+    if not lines:
+        return None
 
-async def process_unsolicited(msg):
-    segments = msg.split(':')
-    code = segments.pop(0)
+    for line in lines:
+        if line.startswith(prefix):
+            return line
+    return None
     
-    data = None
+async def send(command, expect_single_line_response = True, timeout = 1, no_wait = False, terminators = FINAL_RESULT_CODES, prompt = None):
+    cmd = Command(command, timeout, terminators, no_wait, prompt)
+    # The writer resolves every command it takes, so it must never be dropped
+    await write_queue.put(cmd)
+    await cmd.done.wait()
     
-    if len(segments):
-        data = ':'.join(segments)
+    if no_wait:
+        return None, None, None
+
+    command_result = None
+    if cmd.status == 'timeout':
+        debug_queue.put_nowait({'event': 'error', 'data': {'error': 'Timeout error', 'command': command}})
+    elif cmd.frame:
+        command_result = cmd.frame.lines()
+
+    status, result = process_command_result(command, command_result, expect_single_line_response)
+
+    return cmd.status, status, result
         
-    if code == '+CLIP':
-        return await handle_incoming_call(code, data)
-    
-    if code == '+CMTI':
-        return await handle_incoming_sms(code, data)
-    
-    if code == '+CDRIND':
-        return await handle_call_ending(code)
-    
-    if code == 'MO RING' or code == 'MO CONNECTED' or \
-       code == 'BUSY' or code == 'NO CARRIER' or \
-       code == 'NO DIALTONE' or code == 'NO ANSWER':
-        return await handle_call_in_progress(code)
-    
-    if 'POWER' in code or 'VOLTAGE' in code:
-        return await handle_voltage_related_signals(code)
-    
-    await sleep()
+def poll_due(field, now):
+    return time.ticks_diff(now, next_poll[field]) >= 0
+
+def schedule_poll(field, now, interval):
+    next_poll[field] = time.ticks_add(now, interval)
     
-async def send(command, expect_single_line_response = True, timeout = 1, no_wait = False):
-    global line_buffer
-    global last_command
+def schedule_signal_poll(level, now):
+    global signal_poll_ms
+    global last_signal_level
     
-    async with command_lock:
-        last_command = command
-        cmd_timeout = False
-        write_queue.put_nowait(command)
-        if no_wait:
-            await sleep()
-            return None, None, None
+    # Sample fast while the signal moves, back off while it is stable
+    if last_signal_level is None or abs(level - last_signal_level) >= SIGNAL_CHANGE_THRESHOLD:
+        signal_poll_ms = SIGNAL_POLL_MIN_MS
+    else:
+        signal_poll_ms = min(signal_poll_ms * 2, SIGNAL_POLL_MAX_MS)
 
-        send_status = None
-        command_result = None
+    last_signal_level = level
+    schedule_poll('+CSQ', now, signal_poll_ms)
 
-        try:
-            # print('sent', command)
-            send_status, command_result = await asyncio.wait_for(read_queue.get(), timeout)
-            # print('received', send_status, command_result)
-        except asyncio.TimeoutError as e:
-            debug_queue.put_nowait({'event': 'error', 'data': {'error': 'Timeout error', 'command': command}})
-            await sleep()
-            cmd_timeout = True
-            
-        if cmd_timeout:
-            result = line_buffer.copy()
-            line_buffer = []
-            send_status = 'timeout'
-            
-        status = None
-        result = None
+async def query_identity(state):
+    global identity_known
+
+    async with uart_lock.holding('identity'):
+        cmd_status, _, result = await send('ATI')
 
-        status, result = process_command_result(command, command_result, expect_single_line_response)
+        if cmd_status == 'ok':
+            state['product'] = result
 
-        await sleep()
-        if send_status == 'timeout':
-            if write_lock.locked():
-                write_lock.release()
-        return send_status, status, result
+        if is_busy():
+            return
         
+        cmd_status, _, result = await send('AT+GSV')
+
+        if cmd_status == 'ok':
+            state['product_details'] = result
+            identity_known = True
+
 async def query_state():
     global last_state
     global pin_set
@@ -441,15 +676,24 @@ async def query_state():
     global pin_query_fail_count
 
     state = last_state.copy()
-
-    async with uart_lock:
-        cmd_status, _, result = await send('AT+CPIN?', timeout=2)
-        print(cmd_status, _, result)
+    now = time.ticks_ms()
+    
+    # The pin status is always polled: the 'initialized' event it produces
+    # is what keeps the watchdog fed
+    fields = ['+CPIN?']
+    for field in next_poll:
+        if poll_due(field, now):
+            fields.append(field)
+
+    async with uart_lock.holding('status'):
+        cmd_status, _, results = await send('AT' + ';'.join(fields), timeout=2, expect_single_line_response=False)
+        print(cmd_status, _, results)
         
         if is_busy():
             return
         
         if cmd_status == 'ok':
+            result = find_result(results, '+CPIN')
             state['pin_status'] = result
             pin_timeout_count = 0
             
@@ -474,65 +718,55 @@ async def query_state():
                     state['pin_status'] = result
             elif result == '+CPIN: READY':
                 device_queue.put_nowait({'event': 'initialized'})
+
+            result = find_result(results, '+COPS')
+            if result:
+                state['network'] = result
+                schedule_poll('+COPS?', now, NETWORK_POLL_MS)
+
+            result = find_result(results, '+CSQ')
+            if result:
+                state['signal'] = result
+
+                try:
+                    level = int(result.split(':').pop().split(',').pop(0).strip())
+                except:
+                    level = 99
+                
+                if level < 10:
+                    state['signal_friendly'] = 'low'
+                elif level >= 10 and level < 15:
+                    state['signal_friendly'] = 'ok'
+                elif level >= 15 and level < 20:
+                    state['signal_friendly'] = 'good'
+                elif level >= 20 and level < 32:
+                    state['signal_friendly'] = 'excellent'
+                else:
+                    state['signal_friendly'] = 'unknown'
+                    
+                schedule_signal_poll(level, now)
         elif cmd_status == 'timeout':
             pin_timeout_count += 1
             
             if pin_timeout_count > 2:
                 device_queue.put_nowait({'event': 'sim-offline'})
             
-        if is_busy():
-            return
-
-        cmd_status, _, result = await send('AT+COPS?')
-        if cmd_status == 'ok':
-            state['network'] = result
-            
-        if is_busy():
-            return
-
-        cmd_status, _, result = await send('AT+CSQ')
-
-        if cmd_status == 'ok':
-            state['signal'] = result
-
-            try:
-                level = int(result.split(':').pop().split(',').pop(0).strip())
-            except:
-                level = 99
-            
-            if level < 10:
-                state['signal_friendly'] = 'low'
-            elif level >= 10 and level < 15:
-                state['signal_friendly'] = 'ok'
-            elif level >= 15 and level < 20:
-                state['signal_friendly'] = 'good'
-            elif level >= 20 and level < 32:
-                state['signal_friendly'] = 'excellent'
-            else:
-                state['signal_friendly'] = 'unknown'
-
-        if is_busy():
-            return
-
-        cmd_status, _, result = await send('ATI')
-
-        if cmd_status == 'ok':
-            state['product'] = result
-
-        if is_busy():
-            return
-        
-        cmd_status, _, result = await send('AT+GSV')
-
-        if cmd_status == 'ok':
-            state['product_details'] = result
+    if not identity_known and state['pin_status'] == '+CPIN: READY' and not is_busy():
+        await query_identity(state)
         
+    if state != last_state:
         debug_queue.put_nowait({'event':'state', 'data': state})
-        await sleep()
+    last_state = state
 
 async def enter_pin():
+    pin_ready_event.clear()
     await send('AT+CPIN=0000', timeout=5)
-    await sleep(5000)
+    
+    # The modem reports +CPIN: READY once the SIM is unlocked
+    try:
+        await asyncio.wait_for(pin_ready_event.wait(), PIN_READY_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        pass
     
     cmd_status, _, pin_status = await send('AT+CPIN?')
 
@@ -545,54 +779,108 @@ async def enter_pin():
     return 'ERROR', None
 
 async def do_write():
+    global last_command
+    global last_command_parts
+    global in_flight
+
+    # Only one command is in flight at a time: the modem discards input while
+    # it is executing a command. Callers don't hold any lock, they queue the
+    # command and wait for it to be resolved by the reader or by its timeout
     while True:
         command = await write_queue.get()
-        async with write_lock:
-            writer.write(f'{command}\n'.encode())
-            await writer.drain()
+        last_command = command.text
+        last_command_parts = command_parts(command.text)
+        in_flight = command
+        line_reader.prompt = command.prompt
+
+        writer.write(f'{command.text}\n'.encode())
+        await writer.drain()
+        
+        if command.no_wait:
+            in_flight = None
+            command.resolve('ok')
+            continue
+
+        try:
+            await asyncio.wait_for(command.done.wait(), command.timeout)
+        except asyncio.TimeoutError:
+            response_frame.clear()
+            command.resolve('timeout')
+        in_flight = None
+        line_reader.prompt = None
 
 async def do_read():
-    global line_buffer
+    global response_frame
     read_status = 'ok'
+    frame_index = 0
+    # The command whose echo started the current frame
+    answering = None
     while True:
-        line = await reader.readline()
-        try:
-            line = line.decode('utf8').strip()
-        except:
-            line = ''
+        line = await line_reader.readline()
+        received_us = time.ticks_us()
 
-        if len(line) == 0:
-            continue
-        
         if debug_mode:
-            print(line)
+            print(decode(line))
             continue
             
-
-        if is_unsolicited(line):
-            if not is_ignored_urc(line):
+        code = line_code(line)
+        urc = classify_urc(code)
+        if urc:
+            handler, ignored = urc
+            if not ignored:
                 read_status = 'interrupted'
-                urc_queue.put_nowait(line)
+                data = None
+                if len(line) > len(code):
+                    data = decode(line[len(code) + 1:])
+                    
+                if handler is handle_incoming_call and data:
+                    number = clip_number(data)
+                    if number not in clip_received:
+                        clip_received[number] = received_us
+                    # Open the gate before the URC is queued or any lock
+                    # is taken, the hang up follows through the usual path
+                    try_fast_path(number, received_us)
+                    
+                urc_queue.put_nowait([decode(code), data, handler, 1])
             continue
 
-        # print('L', line)
-        line_buffer.append(line)
+        if in_flight and in_flight.echo and is_echo(line, in_flight.echo):
+            # Whatever was read before belongs to a command that timed out
+            response_frame.clear()
+            read_status = 'ok'
+            answering = in_flight
+
+        response_frame.append(line)
         
-        if line == 'OK' or line == 'ERROR' or '+CME ERROR' in line or '+CMS ERROR' in line:
-            await sleep(100)
-            read_queue.put_nowait([read_status, line_buffer.copy()])
-            line_buffer = []
+        terminators = in_flight.terminators if in_flight else FINAL_RESULT_CODES
+        if code in terminators:
+            # A late answer to a command that timed out is dropped here, it
+            # never resolves the command in flight after it
+            if in_flight and (answering is in_flight or not in_flight.echo):
+                in_flight.resolve(read_status, response_frame)
+                frame_index ^= 1
+                response_frame = frames[frame_index]
+            response_frame.clear()
             read_status = 'ok'
-            if write_lock.locked():
-                write_lock.release()
+            answering = None
             continue
         
 async def handle_urc():
     while True:
-        urc = await urc_queue.get()
-        print('U', urc)
+        item = await urc_queue.get()
+        code, data, handler, count = item
+        print('U', code, data, f'(x{count})' if count > 1 else '')
 
-        await process_unsolicited(urc)
+        if handler:
+            urc_workers.get(handler, call_urcs).put_nowait(item)
+        
+async def urc_worker(queue):
+    while True:
+        code, data, handler, _ = await queue.get()
+        try:
+            await process_unsolicited(code, data, handler)
+        except Exception as e:
+            print('Caught exception while handling', code, e)
         
 def toggle_debug_mode(state):
     global debug_mode
@@ -600,7 +888,7 @@ def toggle_debug_mode(state):
     
 async def send_at_command(cmd):
     print('Sending command', cmd)
-    async with uart_lock:
+    async with uart_lock.holding('at-command'):
         await send(cmd, no_wait=True)
 
     
@@ -610,6 +898,9 @@ async def initialize(_device_queue, _debug_queue, _reader, _writer, _watchdog):
     global debug_queue
     global reader
     global writer
+    global line_reader
+    global frames
+    global response_frame
 
     watchdog = _watchdog
     device_queue = _device_queue
@@ -617,13 +908,24 @@ async def initialize(_device_queue, _debug_queue, _reader, _writer, _watchdog):
     
     reader = _reader
     writer = _writer
+    line_reader = LineReader(reader)
+    frames = (Frame(), Frame())
+    response_frame = frames[0]
 
     asyncio.create_task(do_write())
     asyncio.create_task(do_read())
     asyncio.create_task(handle_urc())
+    asyncio.create_task(urc_worker(call_urcs))
+    asyncio.create_task(urc_worker(power_urcs))
+    asyncio.create_task(urc_worker(sms_urcs))
+    asyncio.create_task(serve_calls())
+    asyncio.create_task(uart_lock.supervise(lease_expired))
+    asyncio.create_task(call_state.run())
     
     while True:
-        if not debug_mode:
+        # Polling is suspended while a call or SMS owns the modem
+        await call_state.wait_idle()
+        if not debug_mode and not is_busy():
             await query_state()
 
-        await sleep(1000)
\ No newline at end of file
+        await sleep(STATUS_POLL_MS)
\ No newline at end of file
@@ -0,0 +1,382 @@
+import uasyncio as asyncio
+import gc
+import json
+import os
+import struct
+import time
+
+SNAPSHOT_FILE = 'state.bin'
+# Migrated to the binary snapshot the first time it is found
+LEGACY_FILE = 'state.json'
+TMP_FILE = 'state.tmp'
+# One json line per change, replayed over the snapshot at boot: either
+# [key, value] or, for dicts, [key, {entry: value}, [removed entries]]
+JOURNAL_FILE = 'state.journal'
+# Edits arriving within this window are written in a single append
+FLUSH_DELAY_MS = 1000
+COMPACT_JOURNAL_BYTES = 4096
+
+# magic | version | field count, then for each field:
+# key length (B) | key | kind (B) | value length (I) | value
+MAGIC = b'TPHS'
+VERSION = 2
+HEADER = '<4sBH'
+HEADER_SIZE = struct.calcsize(HEADER)
+FIELD = '<BI'
+FIELD_SIZE = struct.calcsize(FIELD)
+MAX_ENTRY_LENGTH = 0xffff
+KIND_NONE = 0
+KIND_BOOL = 1
+KIND_INT = 2
+KIND_STR = 3
+# str -> str, each one prefixed by its length (H)
+KIND_STR_DICT = 4
+KIND_JSON = 5
+
+state = None
+dirty = []
+# key -> entries of its dict changed since the last flush
+dirty_entries = {}
+dirty_event = asyncio.Event()
+journal_bytes = 0
+stats = {
+    'edits': 0,
+    'flushes': 0,
+    'bytes': 0,
+    'last_bytes': 0,
+    'bytes_per_edit': 0,
+    'last_us': 0,
+    'max_us': 0,
+    'compactions': 0,
+    'journal_bytes': 0,
+    'boot_ms': 0,
+    # Heap still held once loading is done, not the peak while loading.
+    # bench/state_load.py measures the peak
+    'boot_heap_retained': 0
+}
+
+class State():
+    # Keeps the snapshot buffer and only decodes a field the first time it
+    # is read. Fields that are never read never become objects
+
+    def __init__(self, values, buf = None):
+        self.values = values
+        self.fields = {}
+        self.buf = buf
+        if buf is not None:
+            self.index(memoryview(buf))
+
+    def index(self, mv):
+        magic, version, count = struct.unpack_from(HEADER, mv, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Unknown state snapshot')
+
+        offset = HEADER_SIZE
+        for _ in range(count):
+            key_length = mv[offset]
+            offset += 1
+            key = str(mv[offset:offset + key_length], 'utf8')
+            offset += key_length
+            kind, length = struct.unpack_from(FIELD, mv, offset)
+            offset += FIELD_SIZE
+            if offset + length > len(mv):
+                raise ValueError('Truncated state snapshot')
+            self.fields[key] = (kind, offset, length)
+            offset += length
+
+        if offset != len(mv):
+            raise ValueError('Corrupt state snapshot')
+
+    def decode(self, kind, offset, length):
+        mv = memoryview(self.buf)
+        if kind == KIND_NONE:
+            return None
+        if kind == KIND_BOOL:
+            return mv[offset] == 1
+        if kind == KIND_INT:
+            return struct.unpack_from('<i', mv, offset)[0]
+        if kind == KIND_STR:
+            return str(mv[offset:offset + length], 'utf8')
+        if kind == KIND_STR_DICT:
+            value = {}
+            end = offset + length
+            while offset < end:
+                key_length = struct.unpack_from('<H', mv, offset)[0]
+                offset += 2
+                key = str(mv[offset:offset + key_length], 'utf8')
+                offset += key_length
+                value_length = struct.unpack_from('<H', mv, offset)[0]
+                offset += 2
+                value[key] = str(mv[offset:offset + value_length], 'utf8')
+                offset += value_length
+            return value
+        return json.loads(str(mv[offset:offset + length], 'utf8'))
+
+    def __getitem__(self, key):
+        field = self.fields.pop(key, None)
+        if field is not None:
+            self.values[key] = self.decode(*field)
+            if not self.fields:
+                self.buf = None
+        return self.values[key]
+
+    def __setitem__(self, key, value):
+        self.fields.pop(key, None)
+        if not self.fields:
+            self.buf = None
+        self.values[key] = value
+
+    def __contains__(self, key):
+        return key in self.fields or key in self.values
+
+    def get(self, key, default = None):
+        if key in self:
+            return self[key]
+        return default
+
+    def keys(self):
+        return list(self.fields.keys()) + [key for key in self.values if key not in self.fields]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def update(self, values):
+        for key in values:
+            self[key] = values[key]
+
+def encode(value):
+    if value is None:
+        return KIND_NONE, b''
+    if value is True or value is False:
+        return KIND_BOOL, b'\x01' if value else b'\x00'
+    if type(value) is int and -0x80000000 <= value <= 0x7fffffff:
+        return KIND_INT, struct.pack('<i', value)
+    if type(value) is str:
+        return KIND_STR, value.encode('utf8')
+    if type(value) is dict and all([type(k) is str and type(v) is str for k, v in value.items()]):
+        parts = []
+        for k, v in value.items():
+            k = k.encode('utf8')
+            v = v.encode('utf8')
+            if len(k) > MAX_ENTRY_LENGTH or len(v) > MAX_ENTRY_LENGTH:
+                return KIND_JSON, json.dumps(value).encode('utf8')
+            parts.append(struct.pack('<H', len(k)))
+            parts.append(k)
+            parts.append(struct.pack('<H', len(v)))
+            parts.append(v)
+        return KIND_STR_DICT, b''.join(parts)
+    return KIND_JSON, json.dumps(value).encode('utf8')
+
+def write_snapshot(file, source):
+    keys = source.keys()
+    file.write(struct.pack(HEADER, MAGIC, VERSION, len(keys)))
+    size = HEADER_SIZE
+    for key in keys:
+        kind, value = encode(source[key])
+        key = key.encode('utf8')
+        file.write(bytes([len(key)]))
+        file.write(key)
+        file.write(struct.pack(FIELD, kind, len(value)))
+        file.write(value)
+        size += 1 + len(key) + FIELD_SIZE + len(value)
+    return len(keys), size
+
+def verify_snapshot(filename, count, size):
+    # Walks the field headers of a snapshot just written without loading
+    # it, a short write or a wrong length makes the walk miss the end
+    if os.stat(filename)[6] != size:
+        raise ValueError('Short state snapshot')
+
+    with open(filename, 'rb') as file:
+        magic, version, fields = struct.unpack(HEADER, file.read(HEADER_SIZE))
+        if magic != MAGIC or version != VERSION or fields != count:
+            raise ValueError('Corrupt state snapshot')
+
+        offset = HEADER_SIZE
+        for _ in range(fields):
+            offset += 1 + file.read(1)[0]
+            file.seek(offset)
+            kind, length = struct.unpack(FIELD, file.read(FIELD_SIZE))
+            offset += FIELD_SIZE + length
+            if offset > size:
+                raise ValueError('Corrupt state snapshot')
+            file.seek(offset)
+
+    if offset != size:
+        raise ValueError('Corrupt state snapshot')
+
+def replay(target):
+    global journal_bytes
+    journal_bytes = 0
+    entries = 0
+    torn = False
+    try:
+        with open(JOURNAL_FILE, 'r') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn write at the tail, everything before it is good
+                    print('Journal truncated after', entries, 'entries')
+                    torn = True
+                    break
+                if len(entry) == 3:
+                    value = target[entry[0]]
+                    value.update(entry[1])
+                    for removed in entry[2]:
+                        value.pop(removed, None)
+                else:
+                    target[entry[0]] = entry[1]
+                journal_bytes += len(line)
+                entries += 1
+    except OSError:
+        pass
+    return entries, torn
+
+def read_snapshot(defaults):
+    size = os.stat(SNAPSHOT_FILE)[6]
+    buf = bytearray(size)
+    with open(SNAPSHOT_FILE, 'rb') as file:
+        file.readinto(buf)
+    return State(defaults, buf)
+
+def migrate(target):
+    # state.json is only removed once state.bin has been read back at boot
+    with open(LEGACY_FILE, 'r') as file:
+        target.update(json.loads(file.read()))
+    compact()
+    print('Migrated', LEGACY_FILE, 'to', SNAPSHOT_FILE)
+
+def load(defaults):
+    global state
+    gc.collect()
+    free = gc.mem_free()
+    start = time.ticks_ms()
+
+    try:
+        state = read_snapshot(defaults)
+        remove(LEGACY_FILE)
+    except Exception as e:
+        state = State(defaults)
+        try:
+            migrate(state)
+        except Exception as e:
+            print('No last state found')
+
+    # A leftover temp file means compaction didn't finish, the snapshot and
+    # journal it was built from are both still intact
+    remove(TMP_FILE)
+    entries, torn = replay(state)
+    if entries:
+        print('Replayed', entries, 'state changes')
+    # Appending after a torn line would hide every later entry
+    if torn:
+        try:
+            compact()
+        except Exception as e:
+            print('Unable to compact state', e)
+    stats['journal_bytes'] = journal_bytes
+    stats['boot_ms'] = time.ticks_diff(time.ticks_ms(), start)
+    stats['boot_heap_retained'] = free - gc.mem_free()
+    return state
+
+def remove(filename):
+    try:
+        os.remove(filename)
+    except OSError:
+        pass
+
+def clear():
+    remove(SNAPSHOT_FILE)
+    remove(LEGACY_FILE)
+    remove(JOURNAL_FILE)
+
+def changed(keys):
+    for key in keys:
+        if key not in dirty:
+            dirty.append(key)
+        # The whole value is written, the entries with it
+        dirty_entries.pop(key, None)
+    stats['edits'] += 1
+    dirty_event.set()
+
+def changed_entries(key, entries):
+    # Only the given entries of a dict value are journaled, a large caller
+    # list isn't copied to flash for every edit
+    if key not in dirty:
+        pending = dirty_entries.get(key)
+        if pending is None:
+            pending = set()
+            dirty_entries[key] = pending
+        for entry in entries:
+            pending.add(entry)
+    stats['edits'] += 1
+    dirty_event.set()
+
+def journal_line(key):
+    entries = dirty_entries.get(key)
+    if entries is None:
+        return json.dumps([key, state.get(key)]) + '\n'
+
+    value = state.get(key)
+    updated = {}
+    removed = []
+    for entry in entries:
+        if entry in value:
+            updated[entry] = value[entry]
+        else:
+            removed.append(entry)
+    return json.dumps([key, updated, removed]) + '\n'
+
+def compact():
+    global journal_bytes
+    with open(TMP_FILE, 'wb') as file:
+        count, size = write_snapshot(file, state)
+    # A bad snapshot is never renamed over a good one, the journal it
+    # would have replaced stays
+    verify_snapshot(TMP_FILE, count, size)
+    os.rename(TMP_FILE, SNAPSHOT_FILE)
+    remove(JOURNAL_FILE)
+    journal_bytes = 0
+    stats['compactions'] += 1
+
+def flush():
+    global journal_bytes
+    if not dirty and not dirty_entries:
+        return
+
+    start = time.ticks_us()
+    lines = ''.join([journal_line(key) for key in dirty + list(dirty_entries.keys())])
+    with open(JOURNAL_FILE, 'a') as file:
+        file.write(lines)
+    # Kept until they are on flash, a failed write is retried with the
+    # next flush
+    dirty.clear()
+    dirty_entries.clear()
+    journal_bytes += len(lines)
+    written = len(lines)
+
+    if journal_bytes > COMPACT_JOURNAL_BYTES:
+        compact()
+        written += os.stat(SNAPSHOT_FILE)[6]
+
+    elapsed = time.ticks_diff(time.ticks_us(), start)
+    stats['flushes'] += 1
+    stats['bytes'] += written
+    stats['last_bytes'] = written
+    stats['bytes_per_edit'] = stats['bytes'] // stats['edits']
+    stats['last_us'] = elapsed
+    stats['max_us'] = max(stats['max_us'], elapsed)
+    stats['journal_bytes'] = journal_bytes
+
+async def run(on_error):
+    while True:
+        await dirty_event.wait()
+        # Let the edits that follow right after (several web forms saved in
+        # a row) land in the same write
+        await asyncio.sleep_ms(FLUSH_DELAY_MS)
+        dirty_event.clear()
+        try:
+            flush()
+        except Exception as e:
+            on_error(e)
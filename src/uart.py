@@ -1,8 +1,153 @@
 from machine import UART
+from array import array
 import uasyncio as asyncio
 
 BAUDRATE = 115200
 
+LINE_BUFFER_SIZE = 512
+FRAME_BUFFER_SIZE = 1024
+FRAME_MAX_LINES = 32
+
+LF = 10
+SPACE = 32
+
+def decode(line):
+    try:
+        return str(line, 'utf8')
+    except:
+        return ''
+
+class LineReader():
+    # Reads the UART into a preallocated buffer and hands out lines as
+    # memoryview slices of it. A line is only valid until the next readline()
+
+    def __init__(self, stream, size=LINE_BUFFER_SIZE):
+        self._stream = stream
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._size = size
+        self._start = 0
+        self._scan = 0
+        self._end = 0
+        # Set while a command waits for a prompt the modem doesn't end with
+        # LF, like the '> ' AT+CMGS answers with
+        self.prompt = None
+        
+    def _prompted(self):
+        prompt = self.prompt
+        length = len(prompt)
+        offset = self._end - length
+        if offset < self._start:
+            return False
+        for i in range(length):
+            if self._buf[offset + i] != prompt[i]:
+                return False
+        return True
+
+    def _compact(self):
+        buf = self._buf
+        start = self._start
+        length = self._end - start
+        for i in range(length):
+            buf[i] = buf[start + i]
+
+        self._start = 0
+        self._scan -= start
+        self._end = length
+        
+    def _line(self, start, end):
+        buf = self._buf
+        while start < end and buf[start] <= SPACE:
+            start += 1
+        while end > start and buf[end - 1] <= SPACE:
+            end -= 1
+            
+        if start == end:
+            return None
+        return self._mv[start:end]
+
+    async def readline(self):
+        buf = self._buf
+        while True:
+            while self._scan < self._end:
+                i = self._scan
+                self._scan += 1
+                if buf[i] != LF:
+                    continue
+
+                start = self._start
+                self._start = self._scan
+                line = self._line(start, i)
+                if line is not None:
+                    return line
+                
+            if self.prompt and self._prompted():
+                start = self._start
+                self._start = self._scan = self._end
+                line = self._line(start, self._end)
+                if line is not None:
+                    return line
+                
+            if self._start == self._end:
+                self._start = self._scan = self._end = 0
+            elif self._end == self._size:
+                if self._start == 0:
+                    # The line doesn't fit in the buffer. Hand out what we have
+                    self._start = self._scan = self._end = 0
+                    line = self._line(0, self._size)
+                    if line is not None:
+                        return line
+                else:
+                    self._compact()
+                
+            n = await self._stream.readinto(self._mv[self._end:])
+            if n:
+                self._end += n
+            
+class Frame():
+    # Lines of a single command response, copied into a preallocated buffer.
+    # They are only decoded when the response reaches its consumer
+
+    def __init__(self, size=FRAME_BUFFER_SIZE, max_lines=FRAME_MAX_LINES):
+        self._buf = bytearray(size)
+        self._mv = memoryview(self._buf)
+        self._size = size
+        self._ends = array('H', [0] * max_lines)
+        self._max_lines = max_lines
+        self.count = 0
+        
+    def clear(self):
+        self.count = 0
+        
+    def append(self, line):
+        length = len(line)
+        if length > self._size:
+            line = line[:self._size]
+            length = self._size
+
+        # Drop the previous lines if the response doesn't fit, the last line
+        # carries the final result code and must always be kept
+        while self.count:
+            start = self._ends[self.count - 1]
+            if self.count < self._max_lines and start + length <= self._size:
+                break
+            self.count -= 1
+        else:
+            start = 0
+
+        self._mv[start:start + length] = line
+        self._ends[self.count] = start + length
+        self.count += 1
+        
+    def lines(self):
+        lines = []
+        start = 0
+        for i in range(self.count):
+            end = self._ends[i]
+            lines.append(decode(self._mv[start:end]))
+            start = end
+        return lines
+
 async def initialize(config = None):
 
     if config is None:
@@ -17,4 +162,4 @@ async def initialize(config = None):
     reader = asyncio.StreamReader(uart)
     writer = asyncio.StreamWriter(uart)
     
-    return reader, writer
\ No newline at end of file
+    return reader, writer
@@ -2,7 +2,10 @@ import time
 import json
 import uasyncio as asyncio
 import network
-import os
+import caller_db
+import fail_log
+from array import array
+from dynamic_queue import Queue
     
 server_initialized = False
 command_queue = None
@@ -16,6 +19,68 @@ ip = None
 port = None
 wifi_connected_msg_logged = False
 
+TEMPLATE_SLOTS = (
+    '{debug_mode}',
+    '{allowed_callers}',
+    '{logs}',
+    '{current_owner}',
+    '{gate}',
+    '{ep-toggle-duration}',
+    '{fast-path}',
+    '{metrics}',
+    '{caller-db}',
+    '{callers_pager}',
+    '{logs_seq}'
+)
+
+# Counters other modules publish to the admin page
+metrics = {}
+
+# Log lines kept in memory, including the ones from before wifi is up
+LOGS_DEPTH = 32
+
+# /events subscribers, each one gets its own bounded queue. A client that
+# doesn't keep up loses its oldest events instead of holding memory
+MAX_SUBSCRIBERS = 2
+SUBSCRIBER_BUFFER = 16
+EVENTS_PING_S = 15
+subscribers = []
+events_stats = {
+    'subscribers': 0,
+    'sent': 0,
+    'dropped': 0
+}
+
+# Responses are streamed in chunks of this size and drained in between, so
+# the memory used doesn't depend on the size of what is being served
+CHUNK_SIZE = 512
+MAX_POOLED_BUFFERS = 2
+buffer_pool = []
+
+# HTTP/1.1 persistent connections. lwIP on the Pico W has few sockets, so
+# only a couple of idle connections are kept around at a time
+keep_alive_enabled = True
+KEEP_ALIVE_TIMEOUT_S = 5
+MAX_KEEP_ALIVE_CONNECTIONS = 2
+MAX_REQUESTS_PER_CONNECTION = 16
+keep_alive_connections = 0
+
+# Clients over the limit are rejected with a 503 right away. Every phase of
+# a request has a deadline so a slow or half-open client can't hold a socket
+max_connections = 4
+active_connections = 0
+REQUEST_LINE_TIMEOUT_S = 5
+HEADERS_TIMEOUT_S = 5
+BODY_TIMEOUT_S = 10
+MAX_HEADERS = 32
+MAX_CONTENT_LENGTH = 32 * 1024
+
+# index.html compiled into static byte chunks and slot names
+template = None
+# Rendered slots: slot -> (version, bytes)
+slot_cache = {}
+state_version = 0
+
 wifi_status_codes = {
     network.STAT_IDLE: 'idle',
     network.STAT_CONNECTING: 'connecting',
@@ -25,47 +90,154 @@ wifi_status_codes = {
     network.STAT_GOT_IP: 'connected'
 }
 
+class ChunkedWriter():
+    # Frames everything written through it using the chunked transfer coding
+
+    def __init__(self, writer):
+        self._writer = writer
+        
+    def write(self, data):
+        if not len(data):
+            return
+        self._writer.write(f'{len(data):x}\r\n'.encode('ascii'))
+        self._writer.write(data)
+        self._writer.write(b'\r\n')
+        
+    async def drain(self):
+        await self._writer.drain()
+        
+    def finish(self):
+        self._writer.write(b'0\r\n\r\n')
+
 def tstamp():
     now = time.ticks_ms()
     return time.ticks_diff(now, start_ticks) / 1000
 
 class LogsQueue():
+    # Fixed size ring, entries are stored already formatted so the events
+    # themselves aren't kept alive. Sequence numbers only ever grow, a
+    # client passes the last one it saw to fetch what came after it
 
-    def __init__(self, size=16):
-        self.logs = []
-        self._max_size = size
+    def __init__(self, size=LOGS_DEPTH):
+        self._size = size
+        self._seqs = array('I', [0] * size)
+        self._stamps = array('i', [0] * size)
+        self._texts = [None] * size
+        self.version = 0
         
     def put_nowait(self, item):
-        if not server_initialized:
-            return
-
-        if len(self.logs) == self._max_size:
-            self.logs.pop(0)
-            
-        self.logs.append((tstamp(), item))
+        self.version += 1
+        slot = self.version % self._size
+        self._seqs[slot] = self.version
+        self._stamps[slot] = time.ticks_diff(time.ticks_ms(), start_ticks)
+        self._texts[slot] = str(item)
+        
+        for queue in subscribers:
+            if queue.full():
+                events_stats['dropped'] += 1
+            queue.put_nowait(self.version)
+        
+    def entry(self, seq):
+        # None once the ring has wrapped past it
+        slot = seq % self._size
+        if self._seqs[slot] != seq:
+            return None
+        return seq, self._stamps[slot] / 1000, self._texts[slot]
+        
+    def entries(self, since=0):
+        first = max(since + 1, self.version - self._size + 1, 1)
+        items = []
+        for seq in range(first, self.version + 1):
+            slot = seq % self._size
+            items.append((seq, self._stamps[slot] / 1000, self._texts[slot]))
+        return items
         
 logs_queue = LogsQueue()
 
-def url_decode(encoded_str):
-    decoded_str = ''
+PERCENT = 37
+PLUS = 43
+SPACE = 32
+
+def hex_value(c):
+    if 48 <= c <= 57:
+        return c - 48
+    if 97 <= c <= 102:
+        return c - 87
+    if 65 <= c <= 70:
+        return c - 55
+    return -1
+
+def url_decode(encoded):
+    # Works on the raw bytes in a single pass. The output is never longer
+    # than the input, so it is written into a buffer allocated up front and
+    # decoded to str once at the end
+    if type(encoded) is str:
+        encoded = encoded.encode('utf8')
+
+    length = len(encoded)
+    decoded = bytearray(length)
     i = 0
-    while i < len(encoded_str):
-        if encoded_str[i] == '%' and i + 2 < len(encoded_str):
-            hex_value = encoded_str[i + 1:i + 3]
-            decoded_char = chr(int(hex_value, 16))
-            decoded_str += decoded_char
-            i += 3
-        elif encoded_str[i] == '+':
-            decoded_str += ' '
-            i += 1
-        else:
-            decoded_str += encoded_str[i]
-            i += 1
-    return decoded_str
+    n = 0
+    while i < length:
+        c = encoded[i]
+        if c == PERCENT and i + 2 < length:
+            high = hex_value(encoded[i + 1])
+            low = hex_value(encoded[i + 2])
+            if high != -1 and low != -1:
+                decoded[n] = (high << 4) | low
+                n += 1
+                i += 3
+                continue
+        elif c == PLUS:
+            c = SPACE
+
+        decoded[n] = c
+        n += 1
+        i += 1
+        
+    try:
+        return str(memoryview(decoded)[:n], 'utf8')
+    except:
+        return ''
 
 async def sleep(ms = 1000):
     return await asyncio.sleep_ms(ms)
 
+def acquire_buffer():
+    if buffer_pool:
+        return buffer_pool.pop()
+    return bytearray(CHUNK_SIZE)
+
+def release_buffer(buf):
+    if len(buffer_pool) < MAX_POOLED_BUFFERS:
+        buffer_pool.append(buf)
+        
+async def write_chunked(writer, data):
+    mv = memoryview(data)
+    for start in range(0, len(data), CHUNK_SIZE):
+        writer.write(mv[start:start + CHUNK_SIZE])
+        await writer.drain()
+        
+async def write_file(writer, filename, limit = None):
+    # Sends at most limit bytes, returns how many were sent
+    buf = acquire_buffer()
+    mv = memoryview(buf)
+    sent = 0
+    try:
+        with open(filename, 'rb') as file:
+            while limit is None or sent < limit:
+                n = file.readinto(buf)
+                if not n:
+                    break
+                if limit is not None and sent + n > limit:
+                    n = limit - sent
+                writer.write(mv[:n])
+                sent += n
+                await writer.drain()
+    finally:
+        release_buffer(buf)
+    return sent
+
 async def wifi_connect(_ssid, ssid_password):
     global ssid
     global ip
@@ -157,15 +329,35 @@ def parse_uri(uri):
         
     return uri, query_params
 
-def parse_form_data(str_form):
-    url_decoded_form = url_decode(str_form)
-    decoded_form_data = parse_params(url_decoded_form)
-    
+def iter_form_fields(body):
+    # Splits the raw body first and decodes every name and value exactly
+    # once, so encoded '&' and '=' inside values survive
+    mv = memoryview(body)
+    length = len(body)
+    start = 0
+    while start < length:
+        end = body.find(b'&', start)
+        if end == -1:
+            end = length
+            
+        separator = body.find(b'=', start, end)
+        if separator == -1:
+            separator = end
+            
+        name = url_decode(mv[start:separator])
+        if name:
+            value = ''
+            if separator < end:
+                value = url_decode(mv[separator + 1:end])
+            yield name, value
+            
+        start = end + 1
+
+def parse_form_data(body):
     data = {}
-    for item in decoded_form_data:
-        key, value = item
+    for key, value in iter_form_fields(body):
         if key != 'atcommand':
-            value = url_decode(value.strip())
+            value = value.strip()
         if '[]' in key:
             key = key[0:-2]
             
@@ -178,50 +370,120 @@ def parse_form_data(str_form):
             
     return data
                 
+def compile_template(filename):
+    with open(filename, 'r') as file:
+        contents = file.read()
+        
+    chunks = []
+    start = 0
+    while True:
+        slot = None
+        position = -1
+        for name in TEMPLATE_SLOTS:
+            found = contents.find(name, start)
+            if found != -1 and (position == -1 or found < position):
+                position = found
+                slot = name
+
+        if slot is None:
+            chunks.append(contents[start:].encode('utf8'))
+            break
+        
+        chunks.append(contents[start:position].encode('utf8'))
+        chunks.append(slot)
+        start = position + len(slot)
+
+    return chunks
+
+def caller_item(phone, name):
+    return f'<li id="{phone}">{phone} - {name} <input type="hidden" name="name[]" value="{name}"><input type="hidden" name="phone[]" value="{phone}"> <a href="#" rel="{phone}" class="delete-icon" title="Șterge"></a></li>\n'
+
+def query_page(params):
+    for name, value in params:
+        if name == 'page':
+            try:
+                return max(0, int(value))
+            except:
+                pass
+    return 0
+
+def render_caller_page(slot, page):
+    # The flash database is never held in memory, only the requested page
+    # is read and rendered, uncached
+    if slot == '{allowed_callers}':
+        value = ''.join([caller_item(phone, name) for phone, name in caller_db.page(page)])
+    else:
+        pages = caller_db.page_count()
+        value = f'<input type="hidden" name="page" value="{page}"><p>'
+        if page > 0:
+            value += f'<a href="/?page={page - 1}">&laquo;</a> '
+        value += f'Page {page + 1} / {pages}'
+        if page + 1 < pages:
+            value += f' <a href="/?page={page + 1}">&raquo;</a>'
+        value += '</p>'
+    return value.encode('utf8')
+
+def render_slot(slot):
+    if slot == '{debug_mode}':
+        return b'1' if debug_mode else b'0'
+    
+    if slot == '{metrics}':
+        return ''.join([f'{name}: {value}\n' for name, value in metrics.items()]).encode('utf8')
+
+    if slot in ('{logs}', '{logs_seq}'):
+        version = logs_queue.version
+    else:
+        version = state_version
+        
+    cached = slot_cache.get(slot)
+    if cached and cached[0] == version:
+        return cached[1]
     
+    if slot == '{allowed_callers}':
+        value = ''.join([caller_item(phone, name) for phone, name in state['allowed_callers'].items()])
+    elif slot == '{callers_pager}':
+        value = ''
+    elif slot == '{logs}':
+        value = ''.join([f'{tstamp} - {text}\n' for (_, tstamp, text) in logs_queue.entries()])
+    elif slot == '{logs_seq}':
+        value = str(logs_queue.version)
+    elif slot == '{current_owner}':
+        value = state['owner_number']
+    elif slot == '{gate}':
+        value = state['gate_number']
+    elif slot == '{fast-path}':
+        value = 'checked' if state.get('fast_path') else ''
+    elif slot == '{caller-db}':
+        value = 'checked' if state.get('caller_db') else ''
+    else:
+        value = str(state['ep_toggle_duration'])
+        
+    value = value.encode('utf8')
+    slot_cache[slot] = (version, value)
+    return value
+
+async def serve_index(method, _headers, query, _body):
+    global template
 
-async def serve_index(method, _headers, _query, _body):
     if method == 'post':
         return '404', 'Not found', [], ''
     
-    def stream_response(writer):
-        with open('index.html', 'r') as file:
-            allowed_callers = []
-            for phone, name in state['allowed_callers'].items():
-                item = f'<li id="{phone}">{phone} - {name} <input type="hidden" name="name[]" value="{name}"><input type="hidden" name="phone[]" value="{phone}"> <a href="#" rel="{phone}" class="delete-icon" title="Șterge"></a></li>\n'
-                allowed_callers.append(item)
-
-            while True:
-                line = file.readline()
-                if not line:
-                    break
-                
-                if '{debug_mode}' in line:
-                    value = '0'
-                    if debug_mode:
-                        value = '1'
-                    line = line.replace('{debug_mode}', value)
-                
-                if line.strip() == '{allowed_callers}':
-                    for caller in allowed_callers:
-                        writer.write(caller)
-                    continue
-                        
-                if line.strip() == '{logs}':
-                    for (tstamp, item) in logs_queue.logs:
-                        writer.write(f'{tstamp} - {item}\n')
-                    continue
-                
-                if '{current_owner}' in line:
-                    line = line.replace('{current_owner}', state['owner_number'])
-
-                if '{gate}' in line:
-                    line = line.replace('{gate}', state['gate_number'])
-                    
-                if '{ep-toggle-duration}' in line:
-                    line = line.replace('{ep-toggle-duration}', str(state['ep_toggle_duration']))
-                    
-                writer.write(line.encode('utf8'))
+    if template is None:
+        template = compile_template('index.html')
+        
+    page = query_page(query)
+    chunks = []
+    for chunk in template:
+        if type(chunk) is str:
+            if caller_db.enabled and chunk in ('{allowed_callers}', '{callers_pager}'):
+                chunk = render_caller_page(chunk, page)
+            else:
+                chunk = render_slot(chunk)
+        chunks.append(chunk)
+    
+    async def stream_response(writer):
+        for chunk in chunks:
+            await write_chunked(writer, chunk)
             
     return '200', 'OK', [], stream_response
 
@@ -230,23 +492,47 @@ async def serve_update(method, _, query, body):
     if method != 'post':
         return '404', 'Not found', [], ''
     
-    def stream_logs(writer):
+    async def stream_logs(writer):
         try:
-            with open('fail.log', 'r') as fail_log:
-                while True:
-                    line = fail_log.readline()
-                    if not line:
-                        break
-                    
-                    writer.write(line.encode('utf8'))
-        except:
-            pass
+            # Oldest segment first, so the download reads in order
+            for segment, size in segments:
+                if await write_file(writer, segment, size) != size:
+                    raise OSError(f'{segment} rotated while streaming')
+        except Exception as e:
+            # The body is short of Content-length, the connection is
+            # closed instead of kept alive
+            print('Caught exception while streaming logs', e)
+            raise
         
     form_data = {}
     if body:
-        form_data = parse_form_data(body.decode())
+        form_data = parse_form_data(body)
     
-    if ('allowed', '1') in query:
+    if ('allowed', '1') in query and caller_db.enabled:
+        names = form_data.get('name', [])
+        phones = form_data.get('phone', [])
+        if len(names) != len(phones):
+            return '500', 'Internal Server Error', [], 'Mismatch names and phone numbers length!'
+        
+        # Only the page that was shown is posted back, diff it against
+        # what the database holds for that page
+        try:
+            page = max(0, int(form_data.get('page', '0')))
+        except:
+            page = 0
+            
+        shown = {}
+        for phone, name in caller_db.page(page):
+            shown[phone] = name
+            
+        added = []
+        for i in range(0, len(names)):
+            if shown.get(phones[i]) != names[i]:
+                added.append((names[i], phones[i]))
+                
+        removed = [phone for phone in shown if phone not in phones]
+        command_queue.put_nowait({'do': 'update-caller-page', 'payload': {'added': added, 'removed': removed}})
+    elif ('allowed', '1') in query:
         if not 'name' in form_data or not 'phone' in form_data:
             return '500', 'Internal Server Error', [], 'Missing names or phone numbers!'
         
@@ -278,17 +564,22 @@ async def serve_update(method, _, query, body):
             return '500', 'Internal Server Error', [], 'Missing pin toggle duration!'
         
         command_queue.put_nowait({'do': 'update-ep-toggle-duration', 'payload': form_data['ep-toggle-duration']})
+    elif ('caller-db', '1') in query:
+        command_queue.put_nowait({'do': 'update-caller-db', 'payload': form_data.get('caller-db') == '1'})
+    elif ('fast-path', '1') in query:
+        command_queue.put_nowait({'do': 'update-fast-path', 'payload': form_data.get('fast-path') == '1'})
     elif ('check:credit', '1') in query:
         command_queue.put_nowait({'do': 'check-credit'})
     elif ('download:logs', '1') in query:
-        try:
-            fail_log_stat = os.stat('fail.log')
-            file_size = fail_log_stat[6]
+        # Segment sizes when the request came in, Content-length is their
+        # sum. Records appended while streaming are left for the next download
+        segments = fail_log.snapshot()
+        file_size = sum([size for _, size in segments])
+        if file_size:
             response_headers = ['Content-type: text/plain\r\n', f'Content-length: {file_size}\r\n']
             response_headers.append('Content-disposition: attachment; filename="fail.log"\r\n')
             return '200', 'OK', response_headers, stream_logs
-        except:
-            return '404', 'Not found', [], ''
+        return '404', 'Not found', [], ''
     elif ('reset', '1') in query:
         command_queue.put_nowait({'do': 'reset'})
     elif ('debug:mode', '1') in query:
@@ -307,6 +598,95 @@ async def serve_update(method, _, query, body):
     await sleep(250)
     return '302', 'Found', ['Location: /'], ''
 
+async def serve_logs(method, _headers, query, _body):
+    if method == 'post':
+        return '404', 'Not found', [], ''
+    
+    since = 0
+    for name, value in query:
+        if name == 'since':
+            try:
+                since = int(value)
+            except:
+                pass
+            
+    logs = [[seq, stamp, text] for (seq, stamp, text) in logs_queue.entries(since)]
+    return '200', 'OK', ['Content-type: application/json'], json.dumps({'seq': logs_queue.version, 'logs': logs})
+
+def event_message(entry):
+    seq, stamp, text = entry
+    text = text.replace('\n', '\ndata: ')
+    return f'id: {seq}\ndata: {stamp} - {text}\n\n'.encode('utf8')
+
+async def serve_events(method, headers, query, _body):
+    if method == 'post':
+        return '404', 'Not found', [], ''
+    
+    since = None
+    for name, value in query:
+        if name == 'since':
+            since = value
+    
+    # Sent by the browser when it reconnects on its own
+    for h in headers:
+        if h.lower().startswith('last-event-id:'):
+            since = h.split(':', 1)[1].strip()
+            
+    try:
+        since = int(since)
+    except:
+        since = logs_queue.version
+    
+    if len(subscribers) >= MAX_SUBSCRIBERS:
+        return '503', 'Service Unavailable', ['Retry-After: 5'], ''
+    
+    async def stream_events(writer):
+        global active_connections
+        # Only registered once the headers are out, so a failed response
+        # never leaves its queue behind. Checked and registered with no
+        # await in between, a request that lost the last place to another
+        # one ends its stream and the browser retries
+        if len(subscribers) >= MAX_SUBSCRIBERS:
+            writer.write(b'retry: 5000\n\n')
+            return
+
+        queue = Queue(SUBSCRIBER_BUFFER)
+        subscribers.append(queue)
+        events_stats['subscribers'] = len(subscribers)
+        # A stream stays open as long as the page does. Streams are bounded
+        # by MAX_SUBSCRIBERS and don't take one of the request slots
+        active_connections -= 1
+        try:
+            for entry in logs_queue.entries(since):
+                writer.write(event_message(entry))
+            await writer.drain()
+            
+            while True:
+                try:
+                    seq = await asyncio.wait_for(queue.get(), EVENTS_PING_S)
+                except asyncio.TimeoutError:
+                    # Comment line, keeps proxies from closing an idle
+                    # stream and finds out about gone clients
+                    writer.write(b': ping\n\n')
+                    await writer.drain()
+                    continue
+                
+                entry = logs_queue.entry(seq)
+                if entry is None:
+                    continue
+                
+                writer.write(event_message(entry))
+                await writer.drain()
+                events_stats['sent'] += 1
+        finally:
+            active_connections += 1
+            subscribers.remove(queue)
+            events_stats['subscribers'] = len(subscribers)
+            
+    # The connection ends with the stream, it is never reused for another
+    # request
+    return '200', 'OK', ['Content-type: text/event-stream', 'Cache-Control: no-cache', 'Connection: close'], stream_events
+
 async def serve(method, headers, uri, query, body):
     action = None
     
@@ -314,29 +694,21 @@ async def serve(method, headers, uri, query, body):
         action = serve_index
     elif uri == '/update':
         action = serve_update
+    elif uri == '/logs':
+        action = serve_logs
+    elif uri == '/events':
+        action = serve_events
         
     if not action:
         return 404, 'Not found', [], ''
     
     return await action(method, headers, query, body)
 
-async def serve_client(reader, writer):
-    try:
-        request = await reader.readline()
-    except:
-        return
+async def write_error(writer, version = 'HTTP/1.0', status = '500', text = 'Internal Server Error'):
+    writer.write(f'{version} {status} {text}\r\nContent-type: text/html\r\nContent-length: 0\r\nConnection: close\r\n\r\n'.encode('ascii'))
+    await writer.drain()
     
-    try:
-        request = request.decode('utf8').strip()
-    except:
-        request = ''
-        
-    if not request:
-        writer.close()
-        print('Client disconnected')
-        return await writer.wait_closed()
-        
-        
+async def read_headers(reader):
     headers = []
     
     while True:
@@ -353,21 +725,39 @@ async def serve_client(reader, writer):
         if not len(header):
             break
         
+        if len(headers) >= MAX_HEADERS:
+            raise ValueError('Too many headers')
+        
         headers.append(header)
         
+    return headers
+
+async def handle_request(reader, writer, request, can_keep_alive):
+    try:
+        headers = await asyncio.wait_for(read_headers(reader), HEADERS_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        print('Timeout while reading headers. Client disconnected')
+        return False
+    except Exception as e:
+        await write_error(writer)
+        print('Caught exception while reading headers. Client disconnected', e)
+        return False
+        
     read_body = False
+    connection = None
     try:
         for h in headers:
             key, value = h.split(': ', 1)
-            if key.lower() == 'content-length':
+            key = key.lower()
+            if key == 'content-length':
                 value = int(value)
                 read_body = value
+            elif key == 'connection':
+                connection = value.lower()
     except Exception as e:
-        writer.write(b'HTTP/1.0 500 Internal Server Error\r\nContent-type: text/html\r\n\r\n')
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        return print('Caught exception while parsing headers. Client disconnected', e)
+        await write_error(writer)
+        print('Caught exception while parsing headers. Client disconnected', e)
+        return False
     
     segments = request.split(' ')
     method = None
@@ -378,49 +768,164 @@ async def serve_client(reader, writer):
         method = segments.pop(0).lower()
         uri = segments.pop(0).lower()
     except Exception as e:
-        writer.write(b'HTTP/1.0 500 Internal Server Error\r\nContent-type: text/html\r\n\r\n')
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        return print('Caught exception while parsing request. Client disconnected', e)
+        await write_error(writer)
+        print('Caught exception while parsing request. Client disconnected', e)
+        return False
+    
+    version = 'HTTP/1.0'
+    if len(segments) and segments[0].upper() == 'HTTP/1.1':
+        version = 'HTTP/1.1'
+        keep_alive = connection != 'close'
+    else:
+        keep_alive = connection == 'keep-alive'
+        
+    keep_alive = keep_alive and can_keep_alive
    
     uri, query = parse_uri(uri)
     
     if read_body:
-        body = await reader.readexactly(read_body)
+        if read_body > MAX_CONTENT_LENGTH:
+            await write_error(writer, version, '413', 'Payload Too Large')
+            print('Request body too large. Client disconnected', read_body)
+            return False
+
+        try:
+            body = await asyncio.wait_for(reader.readexactly(read_body), BODY_TIMEOUT_S)
+        except asyncio.TimeoutError:
+            print('Timeout while reading body. Client disconnected')
+            return False
         
     try:
         status, text, headers, response = await serve(method, headers, uri, query, body)
     except Exception as e:
-        writer.write(b'HTTP/1.0 500 Internal Server Error\r\nContent-type: text/html\r\n\r\n')
-        await writer.drain()
-        writer.close()
-        await writer.wait_closed()
-        return print('Caught exception while service request. Client disconnected', e)
+        await write_error(writer, version)
+        print('Caught exception while service request. Client disconnected', e)
+        return False
 
-    http_status = f'HTTP/1.0 {status} {text}\r\n'
-    if not len(headers):
-        headers = ['Content-type: text/html\r\n']
-        
-    writer.write(http_status.encode('ascii'))
+    response_headers = []
+    has_length = False
     for h in headers:
-        writer.write(h.encode('ascii'))
+        h = h.strip()
+        if h.lower().startswith('content-length'):
+            has_length = True
+        elif h.lower() == 'connection: close':
+            keep_alive = False
+            continue
+        response_headers.append(h)
+
+    if not len(response_headers):
+        response_headers.append('Content-type: text/html')
+        
+    chunked = False
+    if callable(response):
+        if keep_alive and not has_length:
+            if version == 'HTTP/1.1':
+                chunked = True
+                response_headers.append('Transfer-Encoding: chunked')
+            else:
+                keep_alive = False
+    else:
+        response = response.encode('utf8')
+        response_headers.append(f'Content-length: {len(response)}')
+        
+    if keep_alive:
+        response_headers.append('Connection: keep-alive')
+    else:
+        response_headers.append('Connection: close')
+        
+    writer.write(f'{version} {status} {text}\r\n'.encode('ascii'))
+    for h in response_headers:
+        writer.write(f'{h}\r\n'.encode('ascii'))
         
     writer.write(b'\r\n')
     
     if callable(response):
-        response(writer)
+        if chunked:
+            chunked_writer = ChunkedWriter(writer)
+            await response(chunked_writer)
+            chunked_writer.finish()
+        else:
+            await response(writer)
     elif len(response):
-        writer.write(response.encode('utf8'))
+        writer.write(response)
         
     await writer.drain()
-    writer.close()
-    await writer.wait_closed()
     print(tstamp(), 'Served request', uri)
+    return keep_alive
+
+async def serve_client(reader, writer):
+    global keep_alive_connections
+    global active_connections
+
+    if active_connections >= max_connections:
+        print('Too many clients. Rejecting connection')
+        try:
+            writer.write(b'HTTP/1.0 503 Service Unavailable\r\nRetry-After: 1\r\nContent-length: 0\r\nConnection: close\r\n\r\n')
+            await writer.drain()
+        except:
+            pass
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except:
+            pass
+        return
     
+    active_connections += 1
+    served = 0
+    try:
+        while True:
+            try:
+                if served:
+                    # Idle keep-alive connection waiting for its next request.
+                    # Only idle connections are counted, one busy with a long
+                    # response (an event stream) doesn't hold a place
+                    keep_alive_connections += 1
+                    try:
+                        request = await asyncio.wait_for(reader.readline(), KEEP_ALIVE_TIMEOUT_S)
+                    finally:
+                        keep_alive_connections -= 1
+                else:
+                    request = await asyncio.wait_for(reader.readline(), REQUEST_LINE_TIMEOUT_S)
+            except:
+                break
+            
+            try:
+                request = request.decode('utf8').strip()
+            except:
+                request = ''
+                
+            if not request:
+                print('Client disconnected')
+                break
+            
+            can_keep_alive = keep_alive_enabled and served + 1 < MAX_REQUESTS_PER_CONNECTION and \
+                keep_alive_connections < MAX_KEEP_ALIVE_CONNECTIONS
+
+            keep_alive = await handle_request(reader, writer, request, can_keep_alive)
+            served += 1
+            
+            if not keep_alive:
+                break
+    except Exception as e:
+        print('Caught exception while serving client', e)
+    finally:
+        active_connections -= 1
+        
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except:
+            pass
+    
+def state_changed():
+    global state_version
+    state_version += 1
+
 def set_new_state(_state):
     global state
     state = _state
+    state_changed()
     
 def status():
     if not wlan or not wlan.isconnected():
@@ -429,15 +934,26 @@ def status():
     return True, {'ip': ip, 'port': port}
 
 
-async def initialize(_command_queue, _state, ssid, ssid_password, _port=8080):
+async def initialize(_command_queue, _state, ssid, ssid_password, _port=8080, keep_alive=True, _max_connections=4):
     global server_initialized
     global command_queue
     global state
     global port
+    global template
+    global keep_alive_enabled
+    global max_connections
     
     command_queue = _command_queue
     state = _state
     port = _port
+    keep_alive_enabled = keep_alive
+    max_connections = _max_connections
+    state_changed()
+    
+    try:
+        template = compile_template('index.html')
+    except Exception as e:
+        print('Unable to compile index template', e)
 
     await wifi_connect(ssid, ssid_password)
     asyncio.create_task(asyncio.start_server(serve_client, '0.0.0.0', port))